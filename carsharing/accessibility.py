@@ -0,0 +1,83 @@
+import pickle
+import numpy as np
+import shapely
+import geopandas as gpd
+from shapely import STRtree
+
+
+class PTAccessibilityIndex:
+    """
+    Spatial index over public transport accessibility polygons.
+
+    The polygons are stored in an STRtree, so that the accessibility class
+    of many points is found with one vectorised query. The index can be
+    saved and loaded again, to reuse it for several scenarios (the polygons
+    are stored as WKB and the tree is rebuilt when loading).
+    """
+
+    def __init__(self, pt_accessibility, class_col="class"):
+        """
+        Arguments:
+            pt_accessibility: GeoDataFrame with polygons as geometry and
+            corresponding accessibility class with column name class_col
+            class_col: str, name of column with accessibility class (column
+            must contain numeric values)
+        """
+        self.geoms = np.asarray(pt_accessibility.geometry.values)
+        self.classes = pt_accessibility[class_col].values.astype(float)
+        self.crs = pt_accessibility.crs
+        self.tree = STRtree(self.geoms)
+
+    def lookup(self, points):
+        """
+        Accessibility class of each point (NaN outside of all polygons). If
+        a point lies in several polygons, the first polygon is used.
+        """
+        if getattr(points, "crs", None) is not None and points.crs != self.crs:
+            points = points.to_crs(self.crs)
+        points = np.asarray(points)
+        point_idx, polygon_idx = self.tree.query(points, predicate="intersects")
+        order = np.lexsort((polygon_idx, point_idx))
+        point_idx, polygon_idx = point_idx[order], polygon_idx[order]
+        first = np.ones(len(point_idx), dtype=bool)
+        first[1:] = point_idx[1:] != point_idx[:-1]
+        classes = np.full(len(points), np.nan)
+        classes[point_idx[first]] = self.classes[polygon_idx[first]]
+        return classes
+
+    def lookup_trips(self, trips):
+        """Accessibility classes of the origins and destinations of trips"""
+        points = np.concatenate(
+            [
+                self._to_crs(trips["geom_origin"], trips),
+                self._to_crs(trips["geom_destination"], trips),
+            ]
+        )
+        classes = self.lookup(points)
+        return classes[: len(trips)], classes[len(trips) :]
+
+    def _to_crs(self, geoms, trips):
+        crs = getattr(geoms, "crs", None) or getattr(trips, "crs", None)
+        if crs is not None and crs != self.crs:
+            geoms = gpd.GeoSeries(geoms.values, crs=crs).to_crs(self.crs)
+        return np.asarray(geoms)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["geoms"] = shapely.to_wkb(self.geoms)
+        del state["tree"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.geoms = shapely.from_wkb(self.geoms)
+        self.tree = STRtree(self.geoms)
+
+    def save(self, path):
+        with open(path, "wb") as outfile:
+            pickle.dump(self, outfile)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as infile:
+            return pickle.load(infile)
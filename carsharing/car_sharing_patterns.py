@@ -1,7 +1,6 @@
 import numpy as np
 import geopandas as gpd
 import os
-import time
 import json
 import pandas as pd
 from shapely import wkt
@@ -9,9 +8,56 @@ from ast import literal_eval
 import warnings
 import datetime as dt
 
+from carsharing.profiling import profiled, count, set_fields
+
 RANDOM_DATE = pd.to_datetime("2020-01-20")
 
 
+def sort_decision_times(person_id, decision_time, pad=2 * 60 * 10**9):
+    """
+    Make the decision times of each person non-decreasing in a single pass
+
+    The trips must be sorted by person and activity index, and the decision
+    times are given as int64 (e.g. in ns). A decision time that is earlier
+    than the corrected previous decision time of the same person is moved to
+    `pad` after it. Within a run of moved trips that starts at an unmoved trip
+    j, the corrected time of trip i is t_j + pad * (i - j), so the runs are
+    computed with a cumulative max of t - pad * k per run. Unmoved trips that
+    follow the previous one by less than `pad` start a new run; they are
+    added until there are none left (usually one or two iterations).
+    """
+    decision_time = np.asarray(decision_time, dtype=np.int64)
+    person_id = np.asarray(person_id)
+    n = len(decision_time)
+    if n == 0:
+        return decision_time.copy()
+    pos = np.arange(n)
+    # a run starts at the first trip of every person
+    run_start = np.ones(n, dtype=bool)
+    run_start[1:] = person_id[1:] != person_id[:-1]
+    while True:
+        run_id = np.cumsum(run_start) - 1
+        k = pos - pos[run_start][run_id]
+        corrected = (
+            pd.Series(decision_time - pad * k).groupby(run_id).cummax().values
+            + pad * k
+        )
+        # trips that were not conflicting but are moved by the cumulative max
+        prev_corrected = np.roll(corrected, 1)
+        new_start = (
+            ~run_start
+            & (decision_time >= prev_corrected)
+            & (corrected > decision_time)
+        )
+        if not np.any(new_start):
+            return corrected
+        # only the first one per run is certain to be unmoved
+        candidates = pos[new_start]
+        _, first = np.unique(run_id[candidates], return_index=True)
+        run_start[candidates[first]] = True
+
+
+@profiled()
 def derive_decision_time(
     acts_gdf_mode, avg_drive_speed=50
 ):  # 50 kmh average speed
@@ -34,44 +80,42 @@ def derive_decision_time(
     acts_gdf_mode["mode_decision_time"] = (
         # in seconds, giving 10min decision time
         acts_gdf_mode["started_at_destination"]
-        - pd.Series([dt.timedelta(minutes=d) for d in drive_time_vals])
+        - pd.to_timedelta(drive_time_vals, unit="min")
     )
     # drop the rows of activities that are repeated
     print("Number of activities", len(acts_gdf_mode))
-    acts_gdf_mode = acts_gdf_mode[acts_gdf_mode["distance"] > 0]
+    count("rows", len(acts_gdf_mode))
+    acts_gdf_mode = acts_gdf_mode[acts_gdf_mode["distance"] > 0].copy()
     print("Activities after dropping 0-distance ones:", len(acts_gdf_mode))
+    set_fields(rows_kept=len(acts_gdf_mode))
 
     # correct wrong decision times (sometimes they are lower than the one of
     # the previous activity, due to rough approximation of vehicle speed)
-    cond1, cond2 = np.array([True]), np.array([True])
-    while np.sum(cond1 & cond2) > 0:
-        acts_gdf_mode["prev_dec_time"] = acts_gdf_mode[
-            "mode_decision_time"
-        ].shift(1)
-        acts_gdf_mode["prev_person"] = acts_gdf_mode["person_id"].shift(1)
-        cond1 = (
-            acts_gdf_mode["prev_dec_time"] > acts_gdf_mode["mode_decision_time"]
-        )
-        cond2 = acts_gdf_mode["prev_person"] == acts_gdf_mode["person_id"]
-        if sum(cond1 & cond2) > 0:
-            # reset decision time to after the previously chosen
-            pad_sequence = pd.Series(
-                [dt.timedelta(minutes=2) for _ in range(sum(cond1 & cond2))]
-            )
-            acts_gdf_mode.loc[(cond1 & cond2), "mode_decision_time"] = (
-                acts_gdf_mode.loc[(cond1 & cond2), "prev_dec_time"]
-                + pad_sequence
-            )  # add two minutes to the previous decision time
+    # by moving them to two minutes after the previous decision time
+    decision_time = (
+        pd.DatetimeIndex(acts_gdf_mode["mode_decision_time"]).as_unit("ns").asi8
+    )
+    corrected = sort_decision_times(
+        acts_gdf_mode["person_id"].values, decision_time
+    )
+    acts_gdf_mode["mode_decision_time"] += pd.to_timedelta(
+        corrected - decision_time, unit="ns"
+    )
 
     # now all the decision times should be sorted
-    assert acts_gdf_mode.equals(
-        acts_gdf_mode.sort_values(["person_id", "mode_decision_time"])
+    same_person = (
+        acts_gdf_mode["person_id"].values[1:]
+        == acts_gdf_mode["person_id"].values[:-1]
     )
+    assert np.all(np.diff(corrected)[same_person] >= 0)
+    set_fields(corrected=int(np.sum(corrected != decision_time)))
 
     return acts_gdf_mode
 
 
+@profiled()
 def assign_mode(acts_gdf_mode, station_scenario, mode_choice_function):
+    count("rows", len(acts_gdf_mode))
     # now sort by mode decision time, not by person
     acts_gdf_mode = acts_gdf_mode.sort_values("mode_decision_time")
     # keep track in a dictionary how many vehicles are available at each station
@@ -83,7 +127,6 @@ def assign_mode(acts_gdf_mode, station_scenario, mode_choice_function):
     # keep list of cars that are scheduled to be given back at a certain time
     scheduled_car_returns = []
 
-    tic = time.time()
     final_modes, final_veh_ids, final_start_station, final_end_station = (
         [],
         [],
@@ -115,7 +158,7 @@ def assign_mode(acts_gdf_mode, station_scenario, mode_choice_function):
 
         # check if we already borrowed a car --> need to keep it for return trip
         shared_start = shared_starting_station.get(person_id, None)
-        if shared_start:
+        if shared_start is not None:
             shared_vehicle = shared_vehicle_id[person_id]
             final_veh_ids.append(
                 shared_vehicle
@@ -167,7 +210,9 @@ def assign_mode(acts_gdf_mode, station_scenario, mode_choice_function):
                 # no car available anywhere
                 closest_station = 0
                 distances_to_available_stations = pd.Series([100000]) # set to 100km
+                count("no_vehicle")
             else:
+                count("fallbacks")
                 station_geometries = station_scenario[["geom"]].loc[
                     stations_with_vehicles
                 ]
@@ -186,6 +231,7 @@ def assign_mode(acts_gdf_mode, station_scenario, mode_choice_function):
             ] = distances_to_available_stations.min()
 
         mode = mode_choice_function(row)
+        count("predict_calls")
         # Hard cutoff if distance to car sharing station is disproportionally
         # large, or there is no free station
         if mode == "Mode::CarsharingMobility" and (
@@ -218,7 +264,6 @@ def assign_mode(acts_gdf_mode, station_scenario, mode_choice_function):
             uni, counts = np.unique(final_modes, return_counts=True)
             print({u: c for u, c in zip(uni, counts)})
 
-    print("time for reservation generation:", time.time() - tic)
     acts_gdf_mode["mode"] = final_modes
     acts_gdf_mode["vehicle_no"] = final_veh_ids
     acts_gdf_mode["start_station_no"] = final_start_station
@@ -228,61 +273,51 @@ def assign_mode(acts_gdf_mode, station_scenario, mode_choice_function):
     return acts_gdf_mode
 
 
-def derive_reservations(acts_gdf_mode, mean_h_oneway=1.7, std_h_oneway=0.7):
-    acts_gdf_mode["index_temp"] = acts_gdf_mode.index.values
-    acts_gdf_mode["next_person_id"] = (
-        acts_gdf_mode["person_id"].shift(-1).values
-    )
-    acts_gdf_mode["next_mode"] = acts_gdf_mode["mode"].shift(-1).values
-    # # relevant if including cond5 / cond6
-    # acts_gdf_mode["next_activity_index"] = acts_gdf_mode["activity_index"].shift(-1).values
-    acts_gdf_mode["next_vehicle_no"] = (
-        acts_gdf_mode["vehicle_no"].shift(-1).values
-    )
-    acts_gdf_mode["next_start_station_no"] = (
-        acts_gdf_mode["start_station_no"].shift(-1).values
-    )
-
-    # merge the bookings to subsequent activities:
-    cond = pd.Series(data=False, index=acts_gdf_mode.index)
-    cond_old = pd.Series(data=True, index=acts_gdf_mode.index)
-    cond_diff = cond != cond_old
-
-    while np.sum(cond_diff) >= 1:
-        # .values is important otherwise the "=" would imply a join via the new index
-        acts_gdf_mode["next_id"] = acts_gdf_mode["index_temp"].shift(-1).values
-
-        # identify rows to merge
-        cond0 = acts_gdf_mode["next_person_id"] == acts_gdf_mode["person_id"]
-        cond1 = (
-            acts_gdf_mode["index_temp"] != acts_gdf_mode["next_id"]
-        )  # already merged
-        cond2 = acts_gdf_mode["mode"] == "Mode::CarsharingMobility"
-        cond3 = acts_gdf_mode["next_mode"] == "Mode::CarsharingMobility"
-        cond4 = ~pd.isna(acts_gdf_mode["next_id"])
-        # cond5 = acts_gdf_mode["activity_index"] == acts_gdf_mode["next_activity_index"] - 1
-        # # we cannot trust activity index because the repeated locations were removed --> cond5 is unsuitable.
-        # # therefore, cond 2 and 3 were included instead
-        cond5 = acts_gdf_mode["vehicle_no"] == acts_gdf_mode["next_vehicle_no"]
-        # include cond5? Contra: We might give the vehicle back and borrow another one an hour later at the same
-        # location, # which does not make sense. Pro: If we aggregate two different vehicles, another user might now
-        # have the first vehicle, so one vehicle is used twice by two different users! --> leads to problems
-        # NOTE: there is still a special case if a user by chance borrows the same car again. I decided to ignore it
-        cond6 = (acts_gdf_mode["end_station_no"] == -1) & (
-            acts_gdf_mode["next_start_station_no"] == -1
+def booking_last_trip(acts_gdf_mode):
+    """
+    Position of the last trip of the booking that each trip belongs to.
+    A trip is merged with the next one if both are car sharing trips of the
+    same person with the same vehicle, and the car was not returned to a
+    station in between. The trips must be sorted by person and time.
+    """
+    person_id = acts_gdf_mode["person_id"]
+    shared = acts_gdf_mode["mode"] == "Mode::CarsharingMobility"
+    # we cannot trust activity index because the repeated locations were
+    # removed, therefore the modes of both trips are checked instead
+    link = (
+        (person_id.shift(-1) == person_id)
+        & shared
+        & shared.shift(-1, fill_value=False)
+        # Contra: We might give the vehicle back and borrow another one an hour
+        # later at the same location, which does not make sense. Pro: If we
+        # aggregate two different vehicles, another user might now have the
+        # first vehicle, so one vehicle is used twice by two different users!
+        # NOTE: there is still a special case if a user by chance borrows the
+        # same car again. I decided to ignore it
+        & (
+            acts_gdf_mode["vehicle_no"].shift(-1)
+            == acts_gdf_mode["vehicle_no"]
         )
+        & (acts_gdf_mode["end_station_no"] == -1)
+        & (acts_gdf_mode["start_station_no"].shift(-1) == -1)
+    ).values
+    # runs of linked trips form one booking
+    run_start = np.ones(len(link), dtype=bool)
+    run_start[1:] = ~link[:-1]
+    run_id = np.cumsum(run_start) - 1
+    run_end = np.append(np.flatnonzero(run_start)[1:], len(link)) - 1
+    return run_end[run_id]
+
+
+@profiled()
+def derive_reservations(acts_gdf_mode, mean_h_oneway=1.7, std_h_oneway=0.7):
+    # merge the bookings to subsequent activities, each booking is identified
+    # by the index of its last trip
+    acts_gdf_mode["index_temp"] = acts_gdf_mode.index.values[
+        booking_last_trip(acts_gdf_mode)
+    ]
 
-        cond = cond0 & cond1 & cond2 & cond3 & cond4 & cond5 & cond6
-
-        # assign index to next row
-        acts_gdf_mode.loc[cond, "index_temp"] = acts_gdf_mode.loc[
-            cond, "next_id"
-        ]
-
-        # check whether anything was changed
-        cond_diff = cond != cond_old
-        cond_old = cond.copy()
-
+    count("rows", len(acts_gdf_mode))
     # now after setting the index, reduce to shared
     shared_rides = acts_gdf_mode[
         acts_gdf_mode["mode"] == "Mode::CarsharingMobility"
@@ -301,6 +336,9 @@ def derive_reservations(acts_gdf_mode, mean_h_oneway=1.7, std_h_oneway=0.7):
         "start_station_no": "first",  # first station must be the start station (possibly, the car is not returned)
         "end_station_no": "last",
     }
+    if "day" in acts_gdf_mode.columns:
+        # simulation over several days: day when the booking started
+        agg_dict["day"] = "first"
     sim_reservations = (
         shared_rides.reset_index().groupby(by="index_temp").agg(agg_dict)
     )
@@ -320,7 +358,9 @@ def derive_reservations(acts_gdf_mode, mean_h_oneway=1.7, std_h_oneway=0.7):
         sim_reservations["start_station_no"]
         != sim_reservations["end_station_no"]
     )
-    print("ratio of one way trips", sum(one_way) / len(one_way))
+    if len(one_way) > 0:
+        print("ratio of one way trips", sum(one_way) / len(one_way))
+    set_fields(reservations=len(sim_reservations), one_way=int(sum(one_way)))
     # add some time to return the car
     duration_buffer = pd.Series(
         {
@@ -1,11 +1,12 @@
 import os
+import pickle
+import hashlib
 import pandas as pd
 import argparse
 import numpy as np
-from scipy.stats import poisson
-from datetime import timedelta
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
 
 def chisquare(x, a, b, c):
@@ -26,122 +27,207 @@ def load_real_reservations(in_path):
     return res
 
 
-def fit_distribution_params(real_reservations, plot_distributions=False):
+def hash_reservations(res):
+    """Hash of the reservation columns that are used to fit the distributions"""
+    cols = ["reservationfrom", "start_station_no", "drive_km", "duration", "hour", "weekend"]
+    hashes = pd.util.hash_pandas_object(res[cols], index=False).values
+    return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+
+def _fit_group_curves(args):
+    """Fit the distance and duration distribution of one (weekend, hour) group"""
+    drive_km, duration = args
+    a = np.histogram(drive_km, bins=100)
+    popt_dist, _ = curve_fit(chisquare, a[1][:-1], a[0] / 1000, p0=[0.1, 0.05, 0.3])
+    a = np.histogram(duration, bins=100)
+    try:
+        popt_dur, _ = curve_fit(chisquare, a[1][:-1], a[0] / 300, p0=[10, 0.5, 1])
+    except RuntimeError:
+        # Sometimes the curve fitting does not converge
+        popt_dur = None
+    return popt_dist, popt_dur
+
+
+def fit_distribution_params(real_reservations, plot_distributions=False, nr_processes=None, cache_dir=None):
+    """
+    Fit the distributions of the event-based simulator for each (weekend, hour)
+
+    The curve fits of the groups run in a pool of nr_processes processes. If
+    cache_dir is given, the fitted parameters are saved there, keyed by a hash
+    of the reservations, and loaded instead of fitted again.
+    """
     res = real_reservations.copy()
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"distribution_params_{hash_reservations(res)}.pkl")
+        if os.path.exists(cache_path):
+            print("Loading fitted parameters from", cache_path)
+            with open(cache_path, "rb") as infile:
+                return pickle.load(infile)
+
     # Compute total number of unique weekdays and weekend days --> each hour can occur this many times
     unique_weekdays = res.loc[~res["weekend"], "reservationfrom"].dt.date.sort_values().nunique()
     unique_weekend = res.loc[res["weekend"], "reservationfrom"].dt.date.sort_values().nunique()
-    unique_weekdays, unique_weekend
 
-    # distribution over stations
-    # start with basic dataframe containing the station numbers as indices
-    station_dist = res.groupby("start_station_no")[["start_station_no"]].count().rename({"start_station_no": "all"}, axis=1)
-    poisson_params = {}
-    distance_params = {}
-    duration_params = {}
+    # distribution over stations: one column per (weekend, hour) with the categorical distribution
+    station_counts = res.groupby(["weekend", "hour", "start_station_no"]).size().unstack([0, 1])
+    station_dist_hour = station_counts / station_counts.sum()
+    station_dist_hour.columns = [f"{int(w)}-{h}" for w, h in station_dist_hour.columns]
+    station_dist = pd.concat([station_counts.sum(axis=1).rename("all"), station_dist_hour], axis=1)
 
+    groups = []
+    poisson_params = {}
+    fit_inputs = []
     for (w, h), res_subset in res.groupby(["weekend", "hour"]):
+        groups.append((h, w))
         # get rate
         if w:
             # 0.5 because getting the rate for half an hour
             poisson_params[(h, w)] = 0.5 * len(res_subset) / unique_weekend
         else:
             poisson_params[(h, w)] = 0.5 * len(res_subset) / unique_weekdays
-            
-        # get categorical distribution over stations
-        station_dist_hour = res_subset.groupby("start_station_no")[["start_station_no"]].count().rename({"start_station_no": f"{int(w)}-{h}"}, axis=1)
-        station_dist_hour = station_dist_hour / station_dist_hour.sum()
-        station_dist = station_dist.merge(station_dist_hour, how="left", left_index=True, right_index=True)
-        
-        # get distance dist --> chisquare
-        drive_km = res_subset.loc[(res_subset["drive_km"] < 300) & (res_subset["drive_km"]>0), "drive_km"]
-        if plot_distributions:
-            a = plt.hist(drive_km, bins=100)
+        # distance and duration are fitted with a chisquare
+        drive_km = res_subset.loc[(res_subset["drive_km"] < 300) & (res_subset["drive_km"]>0), "drive_km"].values
+        duration = res_subset.loc[(res_subset["duration"] < 24) & (res_subset["duration"]>0), "duration"].values
+        fit_inputs.append((drive_km, duration))
+
+    with ProcessPoolExecutor(max_workers=nr_processes) as pool:
+        fitted = list(pool.map(_fit_group_curves, fit_inputs))
+
+    distance_params = {}
+    duration_params = {}
+    popt_dur = None
+    for (h, w), (drive_km, duration), (popt_dist, popt_dur_group) in zip(groups, fit_inputs, fitted):
+        distance_params[(h, w)] = popt_dist
+        if popt_dur_group is not None:
+            popt_dur = popt_dur_group
+        elif popt_dur is not None:
+            print("Using parameters of previous hour")
         else:
-            a = np.histogram(drive_km, bins=100)
-        x = a[1][:-1]
-        y = a[0] / 1000
-        popt_dist, pcov = curve_fit(chisquare, x, y, p0=[0.1, 0.05, 0.3])
-    #     print(popt_dist)
+            raise RuntimeError(f"Fitting the duration of hour {h} did not converge")
+        duration_params[(h, w)] = popt_dur
+
         if plot_distributions:
+            plt.hist(drive_km, bins=100)
             xx = np.linspace(0, 100, 100)
-            yy = chisquare(xx, *popt_dist)
-            plt.plot(xx, yy * 1000, lw=5)
+            plt.plot(xx, chisquare(xx, *popt_dist) * 1000, lw=5)
             plt.title("Distance")
             plt.show()
-        # APPEND
-        distance_params[(h, w)] = popt_dist
-        
-        # get duration dist --> chisquare
-        duration = res_subset.loc[(res_subset["duration"] < 24) & (res_subset["duration"]>0), "duration"]
-        if plot_distributions:
-            a = plt.hist(duration, bins=100, color="blue")
-        else:
-            a = np.histogram(duration, bins=100)
-        x = a[1][:-1]
-        y = a[0] / 300
-        try:
-            popt_dur, _ = curve_fit(chisquare, x, y, p0=[10, 0.5, 1])
-        except RuntimeError:
-            # Sometimes the curve fitting does not converge
-            print("Using parameters of previous hour")
-            pass
-        # print(popt_dur)
-        if plot_distributions:
+            plt.hist(duration, bins=100, color="blue")
             xx = np.linspace(0, 24, 100)
-            yy = chisquare(xx, *popt_dur)
-            plt.plot(xx, yy * 300, lw=5)
+            plt.plot(xx, chisquare(xx, *popt_dur) * 300, lw=5)
             plt.title("Duration")
             plt.show()
-        # APPEND
-        duration_params[(h, w)] = popt_dur
 
-    return {"station": station_dist, "duration": duration_params, 
-            "distance": distance_params, "poisson": poisson_params} 
-     
+    param_dict = {"station": station_dist, "duration": duration_params,
+            "distance": distance_params, "poisson": poisson_params}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "wb") as outfile:
+            pickle.dump(param_dict, outfile)
+    return param_dict
+
 
-def simulated_eventbased(out_path, distribution_param_dict, w=False):
-    slots = 48 # simulate one day, every half an hour
-    slot_names = [SIMULATED_DAY + timedelta(minutes=30 * i) for i in range(48)]
+def sample_categorical(probs, rows, rng):
+    """
+    Draw one category for each entry of `rows` from the distribution in the
+    corresponding row of `probs` (inverse transform sampling)
+    """
+    cdf = np.cumsum(probs, axis=1)
+    cdf = cdf / cdf[:, -1:]
+    cdf[:, -1] = 1
+    # shift each row by its row number, so that all rows can be searched at once
+    nr_categories = probs.shape[1]
+    cdf = (cdf + np.arange(len(probs))[:, None]).ravel()
+    inds = np.searchsorted(cdf, rows + rng.random(len(rows)), side="right")
+    return inds - rows * nr_categories
+
+
+def generate_eventbased_days(
+    distribution_param_dict, nr_days=1, w=False, max_km=200, seed=None
+):
+    """
+    Simulate the reservations of `nr_days` independent days at once
+
+    The number of bookings of every half-hour slot of every day is drawn from
+    the poisson distribution of the hour, and the stations, durations and
+    distances of all bookings are drawn with one call per attribute. The
+    distances are drawn from the fitted density on a grid of 0.1km bins
+    (uniformly within the bin) instead of from random candidates per slot.
+    """
+    rng = np.random.default_rng(seed)
+    hours = np.arange(24)
+    slots = 48  # simulate one day, every half an hour
+
+    # number of bookings per day and slot
+    rates = np.array([distribution_param_dict["poisson"][(h, w)] for h in hours])
+    num_bookings = rng.poisson(np.repeat(rates, 2), size=(nr_days, slots))
+    day = np.repeat(np.repeat(np.arange(nr_days), slots), num_bookings.ravel())
+    slot = np.repeat(np.tile(np.arange(slots), nr_days), num_bookings.ravel())
+    booking_hour = slot // 2
+
+    # draw duration
     possible_durations = np.arange(0.5, 24, 0.5)
-    booking_dfs = []
-    for slot in range(slots):
-        h = slot // 2
-        num_bookings = poisson.rvs(distribution_param_dict["poisson"][(h, w)], size=1) # draw from poisson distribution the events / 0.5h
-        
-        # draw duration
-        dur_params = distribution_param_dict["duration"][(h, w)]
-        duration_probs = chisquare(possible_durations, *dur_params)
-        booking_durations = np.random.choice(possible_durations, p = duration_probs / np.sum(duration_probs), size=num_bookings)
-
-        # draw distance
-        dist_params = distribution_param_dict["distance"][(h, w)]
-        possible_distances = np.random.uniform(0, 200, 200)  # randomize
-        distance_probs = chisquare(possible_distances, *dist_params)
-        booking_distances = np.random.choice(possible_distances, p = distance_probs / np.sum(distance_probs), size=num_bookings)
-        # TODO: duration not really aligned with distance (but it's the reservation duration, so maybe fine)
-        
-    #     print(num_bookings, booking_durations)
-        # draw stations
-        stations_avail = distribution_param_dict["station"][f"{int(w)}-{h}"]
-        stations_avail = stations_avail.dropna()
-    #     print(stations_avail)
-        booking_stations = np.random.choice(stations_avail.index, p=stations_avail.values, size=num_bookings)
-        
-        booking_df = pd.DataFrame()
-        booking_df["start_station_no"] = booking_stations
-        booking_df["drive_km"] = booking_distances
-        booking_df["duration"] = booking_durations
-        booking_df["start_station_no"] = booking_stations
-        booking_df["reservationfrom"] = slot_names[slot]
-        booking_dfs.append(booking_df)
-    booking_dfs = pd.concat(booking_dfs)
-
-    # add reservationto
-    booking_dfs["reservationto"] = [row["reservationfrom"] + timedelta(hours=row["duration"]) for i, row in booking_dfs.iterrows()]
-    booking_dfs.reset_index(drop=True, inplace=True)
-    booking_dfs.index.name = "reservation_no"
-    booking_dfs.to_csv(os.path.join(out_path, "sim_reservations.csv"))
+    duration_probs = np.array(
+        [
+            chisquare(possible_durations, *distribution_param_dict["duration"][(h, w)])
+            for h in hours
+        ]
+    )
+    booking_durations = possible_durations[
+        sample_categorical(duration_probs, booking_hour, rng)
+    ]
+
+    # draw distance
+    bin_width = 0.1
+    bin_centers = np.arange(0, max_km, bin_width) + bin_width / 2
+    distance_probs = np.array(
+        [
+            chisquare(bin_centers, *distribution_param_dict["distance"][(h, w)])
+            for h in hours
+        ]
+    )
+    booking_distances = (
+        bin_centers[sample_categorical(distance_probs, booking_hour, rng)]
+        + (rng.random(len(slot)) - 0.5) * bin_width
+    )
+    # TODO: duration not really aligned with distance (but it's the reservation duration, so maybe fine)
+
+    # draw stations
+    station_probs = (
+        distribution_param_dict["station"][[f"{int(w)}-{h}" for h in hours]]
+        .fillna(0)
+    )
+    booking_stations = station_probs.index.values[
+        sample_categorical(station_probs.values.T, booking_hour, rng)
+    ]
+
+    reservationfrom = (
+        SIMULATED_DAY
+        + pd.to_timedelta(day, unit="D")
+        + pd.to_timedelta(30 * slot, unit="min")
+    )
+    booking_df = pd.DataFrame(
+        {
+            "day": day,
+            "start_station_no": booking_stations,
+            "drive_km": booking_distances,
+            "duration": booking_durations,
+            "reservationfrom": reservationfrom,
+            "reservationto": reservationfrom
+            + pd.to_timedelta(booking_durations, unit="h"),
+        }
+    )
+    booking_df.index.name = "reservation_no"
+    return booking_df
+
+
+def simulated_eventbased(out_path, distribution_param_dict, w=False, nr_days=1):
+    booking_df = generate_eventbased_days(
+        distribution_param_dict, nr_days=nr_days, w=w
+    )
+    if nr_days == 1:
+        booking_df.drop("day", axis=1, inplace=True)
+    booking_df.to_csv(os.path.join(out_path, "sim_reservations.csv"))
 
 
 if __name__ == "__main__":
@@ -160,9 +246,34 @@ if __name__ == "__main__":
         default=os.path.join("outputs", "event_based_simulation"),
         help="Path where to output the simulated reservations",
     )
+    parser.add_argument(
+        "-n",
+        "--nr_days",
+        type=int,
+        default=1,
+        help="Number of independent days to simulate",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes for fitting the distributions",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache_dir",
+        type=str,
+        default=os.path.join("outputs", "distribution_params"),
+        help="Directory where the fitted distributions are cached",
+    )
     args = parser.parse_args()
     os.makedirs(args.out_path, exist_ok=True)
 
     real_reservations = load_real_reservations(args.in_path)
-    fitted_parameters = fit_distribution_params(real_reservations, plot_distributions=False)
-    simulated_eventbased(args.out_path, fitted_parameters, w=SIMULATE_WEEKEND)
+    fitted_parameters = fit_distribution_params(
+        real_reservations, plot_distributions=False, nr_processes=args.processes, cache_dir=args.cache_dir
+    )
+    simulated_eventbased(
+        args.out_path, fitted_parameters, w=SIMULATE_WEEKEND, nr_days=args.nr_days
+    )
@@ -0,0 +1,521 @@
+import os
+import math
+import heapq
+import time
+import numpy as np
+import pandas as pd
+
+from carsharing.spatial_index import AvailableStationIndex
+from carsharing.fleet import FleetState
+from carsharing.profiling import profiled, count, set_fields
+from carsharing.car_sharing_patterns import (
+    booking_last_trip,
+    derive_reservations,
+)
+
+CARSHARING_MODE = "Mode::CarsharingMobility"
+
+
+def to_int_time(values):
+    """Convert a datetime column to int64 nanoseconds (comparable in a heap)"""
+    return pd.DatetimeIndex(values).as_unit("ns").asi8
+
+
+class EventEngine:
+    """
+    Discrete-event simulation of the car sharing fleet.
+
+    Mode decisions and vehicle returns are both events keyed on time. The
+    decisions are consumed in order of their decision time, and the scheduled
+    vehicle returns are kept in a priority queue, so that all returns that are
+    due before a decision are processed first. The trips are read from
+    columnar NumPy arrays instead of iterating over the rows of the dataframe.
+    The state of the fleet is kept across calls to `run`.
+
+    If the mode choice model supports batch inference (attribute
+    `batch_inference`), decisions are grouped into windows of `batch_size`
+    decisions. All decisions of a window that cannot affect each other's
+    outcome are predicted with a single call of the model, and only the
+    decisions that compete for the last vehicles at a station are evaluated
+    sequentially.
+
+    An `OccupancyRecorder` can be passed to record the available vehicles
+    per station at fixed intervals, and the decisions that had to fall back
+    to a further station.
+    """
+
+    def __init__(
+        self,
+        station_scenario,
+        mode_choice_function,
+        batch_size=256,
+        log_every=100000,
+        recorder=None,
+    ):
+        self.mode_choice_function = mode_choice_function
+        self.recorder = recorder
+        self.batch_size = batch_size
+        self.log_every = log_every
+
+        # stations are addressed by their position in the station table
+        self.station_nos = station_scenario.index.values
+        self.station_pos = {s: i for i, s in enumerate(self.station_nos)}
+        self.station_x = station_scenario["geom"].x.values
+        self.station_y = station_scenario["geom"].y.values
+
+        # available vehicles per station (borrow from the top of the stack)
+        self.fleet = FleetState(station_scenario["vehicle_list"].tolist())
+        # number of available vehicles per station (updated by the fleet)
+        self.nr_avail = self.fleet.nr_avail
+        # nearest-neighbour index over the stations with available vehicles
+        self.station_index = AvailableStationIndex(
+            self.station_x, self.station_y, self.nr_avail > 0
+        )
+        # person_id -> (start station, start location, vehicle ID) of the
+        # currently borrowed car
+        self.borrowed = {}
+        # priority queue of (return time, sequence number, station, vehicle)
+        self.scheduled_returns = []
+        self._return_seq = 0
+
+        self.nr_decisions = 0
+        self.nr_predict_calls = 0
+        self.nr_batched = 0
+        self.runtime = 0
+
+    def return_vehicles(self, until_time):
+        """Return all vehicles that are scheduled for return until a time"""
+        while (
+            self.scheduled_returns and self.scheduled_returns[0][0] <= until_time
+        ):
+            _, _, station, vehicle = heapq.heappop(self.scheduled_returns)
+            pos = self.station_pos[station]
+            self.fleet.return_vehicle(pos, vehicle)
+            if self.nr_avail[pos] == 1:
+                self.station_index.set_available(pos, True)
+
+    def record_until(self, until_time=None):
+        """
+        Record the state of the fleet at all samples of the recorder until a
+        time (all remaining samples if until_time is None). The returns that
+        are due before a sample are processed first.
+        """
+        recorder = self.recorder
+        while recorder.slot < recorder.nr_slots and (
+            until_time is None or recorder.next_time <= until_time
+        ):
+            self.return_vehicles(recorder.next_time)
+            recorder.record(self.nr_avail)
+
+    def schedule_return(self, return_time, station, vehicle):
+        heapq.heappush(
+            self.scheduled_returns,
+            (return_time, self._return_seq, station, vehicle),
+        )
+        self._return_seq += 1
+
+    def borrow_vehicle(self, station):
+        pos = self.station_pos[station]
+        vehicle = self.fleet.borrow(pos)
+        if self.nr_avail[pos] == 0:
+            self.station_index.set_available(pos, False)
+        return vehicle
+
+    def closest_available_station(self, x, y, candidates=None):
+        """
+        Closest station with at least one vehicle, or (None, inf). If the
+        positions of the closest stations are given (ordered by distance),
+        the first one with a vehicle is taken, and the index is only
+        searched if none of them has a vehicle.
+        """
+        if candidates is not None:
+            for pos in candidates:
+                if pos >= 0 and self.nr_avail[pos] > 0:
+                    dx, dy = self.station_x[pos] - x, self.station_y[pos] - y
+                    return self.station_nos[pos], math.sqrt(dx * dx + dy * dy)
+        pos, distance = self.station_index.nearest(x, y)
+        if pos < 0:
+            return None, distance
+        return self.station_nos[pos], distance
+
+    def predict_window(self, acts_gdf_mode, start, stop, persons, stations):
+        """
+        Predict the modes of all decisions in the window [start, stop) that
+        cannot be affected by the other decisions in the window.
+
+        A decision is independent if the person does not hold a car, has no
+        other decision in the window, and its closest station cannot run
+        empty before the decision: fewer decisions precede it that could
+        borrow a car there (at the same station, or redirected from a station
+        that may be empty) than there are vehicles at the station. Returns
+        the positions of the predicted decisions and their modes.
+        """
+        persons, stations = persons[start:stop], stations[start:stop]
+        _, person_inverse, person_counts = np.unique(
+            persons, return_inverse=True, return_counts=True
+        )
+        repeated = person_counts[person_inverse] > 1
+        person_ids = acts_gdf_mode["person_id"].values[start:stop]
+        holding = np.array([p in self.borrowed for p in person_ids], dtype=bool)
+        # decisions that could possibly borrow a car in this window
+        is_competing = (~holding | repeated) & (stations >= 0)
+        competing = np.flatnonzero(is_competing)
+        # number of competing decisions at the same station before each one
+        order = competing[np.argsort(stations[competing], kind="stable")]
+        group_start = np.r_[0, np.flatnonzero(np.diff(stations[order])) + 1]
+        group_sizes = np.diff(np.r_[group_start, len(order)])
+        rank = np.zeros(len(stations), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - np.repeat(
+            group_start, group_sizes
+        )
+        # decisions whose station may be empty can borrow at any station
+        capacity = np.where(stations >= 0, self.nr_avail[stations], 0)
+        redirected = np.zeros(len(stations), dtype=bool)
+        while True:
+            redirected_before = np.cumsum(redirected) - redirected
+            new_redirected = is_competing & (
+                rank + redirected_before >= capacity
+            )
+            if np.array_equal(new_redirected, redirected):
+                break
+            redirected = new_redirected
+        independent = ~holding & ~repeated & is_competing & ~redirected
+        positions = start + np.flatnonzero(independent)
+        if len(positions) == 0:
+            return positions, np.array([], dtype=object)
+        features = acts_gdf_mode.iloc[positions]
+        if hasattr(self.mode_choice_function, "predict_modes"):
+            modes = self.mode_choice_function.predict_modes(features)
+        else:
+            modes = np.atleast_1d(self.mode_choice_function(features))
+        self.nr_predict_calls += 1
+        self.nr_batched += len(positions)
+        return positions, modes
+
+    @profiled("event_engine")
+    def run(self, acts_gdf_mode, station_candidates=None):
+        """
+        Assign a mode to each trip (same output columns as `assign_mode`)
+
+        station_candidates can be an int array with the station numbers of
+        the k closest stations of each trip origin (ordered by distance, one
+        row per row of acts_gdf_mode, see `nearest_station_candidates`).
+        """
+        # now sort by mode decision time, not by person
+        sorted_acts = acts_gdf_mode.sort_values("mode_decision_time")
+        candidate_rows = None
+        if station_candidates is not None:
+            # the table stays compact; the candidates of a decision are only
+            # converted to station positions if its closest station is empty
+            station_candidates = np.asarray(station_candidates)
+            candidate_rows = acts_gdf_mode.index.get_indexer(sorted_acts.index)
+        acts_gdf_mode = sorted_acts
+        nr_rows = len(acts_gdf_mode)
+
+        # columnar state of the decisions
+        decision_time = to_int_time(acts_gdf_mode["mode_decision_time"])
+        return_time = to_int_time(acts_gdf_mode["started_at_destination"])
+        person_id = acts_gdf_mode["person_id"].values
+        closest_origin = acts_gdf_mode["closest_station_origin"].values.copy()
+        closest_destination = acts_gdf_mode[
+            "closest_station_destination"
+        ].values
+        location_origin = acts_gdf_mode["location_id_origin"].values
+        location_destination = acts_gdf_mode["location_id_destination"].values
+        distance = acts_gdf_mode["distance"].values
+        dist_station = acts_gdf_mode["distance_to_station_origin"].values
+        origin_x = acts_gdf_mode["geom_origin"].x.values
+        origin_y = acts_gdf_mode["geom_origin"].y.values
+        index, columns = acts_gdf_mode.index, acts_gdf_mode.columns
+        col_closest = columns.get_loc("closest_station_origin")
+        col_dist_station = columns.get_loc("distance_to_station_origin")
+        col_feat_dist_station = columns.get_loc(
+            "feat_distance_to_station_origin"
+        )
+
+        final_modes = np.empty(nr_rows, dtype=object)
+        final_veh_ids = np.full(nr_rows, -1, dtype=np.int64)
+        final_start_station = np.full(nr_rows, -1, dtype=np.int64)
+        final_end_station = np.full(nr_rows, -1, dtype=np.int64)
+        mode_counts = {}
+
+        # rows are converted to python objects in blocks (bounded memory)
+        block_size = 10000
+        block, block_start = None, -block_size
+
+        # modes that were predicted in a batch
+        batch_size = (
+            self.batch_size
+            if getattr(self.mode_choice_function, "batch_inference", False)
+            else 0
+        )
+        batch_modes = np.empty(nr_rows, dtype=object)
+        has_prediction = np.zeros(nr_rows, dtype=bool)
+        person_codes = pd.factorize(person_id)[0]
+        closest_pos = pd.Index(self.station_nos).get_indexer(closest_origin)
+        window_end = 0
+
+        recorder = self.recorder
+        nr_predict_calls, nr_batched = self.nr_predict_calls, self.nr_batched
+        tic = time.time()
+        for i in range(nr_rows):
+            # record the occupancy if a sample is due
+            if (
+                recorder is not None
+                and decision_time[i] >= recorder.next_time
+            ):
+                self.record_until(decision_time[i])
+            # return all cars that are scheduled for return
+            self.return_vehicles(decision_time[i])
+
+            if batch_size and i >= window_end:
+                window_end = min(i + batch_size, nr_rows)
+                positions, modes = self.predict_window(
+                    acts_gdf_mode, i, window_end, person_codes, closest_pos
+                )
+                batch_modes[positions] = modes
+                has_prediction[positions] = True
+
+            # check if we already borrowed a car --> keep it for return trip
+            borrowed = self.borrowed.get(person_id[i], None)
+            if borrowed is not None:
+                shared_start, shared_start_loc, shared_vehicle = borrowed
+                final_modes[i] = CARSHARING_MODE
+                final_veh_ids[i] = shared_vehicle
+                # check whether we are back at the start station or location
+                if (
+                    shared_start == closest_destination[i]
+                    or shared_start_loc == location_destination[i]
+                ):
+                    self.schedule_return(
+                        return_time[i], shared_start, shared_vehicle
+                    )
+                    del self.borrowed[person_id[i]]
+                    final_end_station[i] = shared_start
+                mode_counts[CARSHARING_MODE] = (
+                    mode_counts.get(CARSHARING_MODE, 0) + 1
+                )
+                continue
+
+            # otherwise: decide whether to borrow the car
+            closest_station = closest_origin[i]
+            dist_to_station = dist_station[i]
+            vehicle_available = True
+            # the batched prediction is only valid if the closest station
+            # still has a vehicle (otherwise, the features change)
+            if has_prediction[i] and self.nr_avail[closest_pos[i]] > 0:
+                mode = batch_modes[i]
+            else:
+                if i >= block_start + block_size:
+                    block_start = i
+                    block = acts_gdf_mode.iloc[i : i + block_size].to_numpy(
+                        dtype=object
+                    )
+                row_values = block[i - block_start].copy()
+                if self.nr_avail[self.station_pos[closest_station]] < 1:
+                    # recompute distance to closest station with vehicles
+                    closest_station, dist_to_station = (
+                        self.closest_available_station(
+                            origin_x[i],
+                            origin_y[i],
+                            candidates=(
+                                None
+                                if candidate_rows is None
+                                else [
+                                    self.station_pos.get(station_no, -1)
+                                    for station_no in station_candidates[
+                                        candidate_rows[i]
+                                    ].tolist()
+                                ]
+                            ),
+                        )
+                    )
+                    if closest_station is None:
+                        # no car available anywhere (set distance to 100km)
+                        closest_station, dist_to_station = 0, 100000
+                        vehicle_available = False
+                        count("no_vehicle")
+                        if recorder is not None:
+                            recorder.count_no_vehicle()
+                    else:
+                        count("fallbacks")
+                        if recorder is not None:
+                            recorder.count_fallback()
+                    closest_origin[i] = closest_station
+                    row_values[col_closest] = closest_station
+                    row_values[col_dist_station] = dist_to_station
+                    row_values[col_feat_dist_station] = dist_to_station
+
+                mode = self.mode_choice_function(
+                    pd.Series(row_values, index=columns, name=index[i])
+                )
+                self.nr_predict_calls += 1
+            # Hard cutoff if distance to car sharing station is
+            # disproportionally large, or there is no free station
+            if mode == CARSHARING_MODE and (
+                dist_to_station > distance[i] * 0.5
+                or pd.isna(closest_station)
+                or not vehicle_available
+            ):
+                mode = "Mode::Car"
+
+            # if shared, set vehicle as borrowed and remember the pick up
+            # station (for return)
+            if mode == CARSHARING_MODE:
+                vehicle = self.borrow_vehicle(closest_station)
+                self.borrowed[person_id[i]] = (
+                    closest_station,
+                    location_origin[i],
+                    vehicle,
+                )
+                final_veh_ids[i] = vehicle
+                final_start_station[i] = closest_station
+            final_modes[i] = mode
+            mode_counts[mode] = mode_counts.get(mode, 0) + 1
+
+            if (i + 1) % self.log_every == 0:
+                print(
+                    f"Step {i + 1}: decisions/sec",
+                    round((i + 1) / (time.time() - tic)),
+                    "current mode share:",
+                    mode_counts,
+                )
+
+        runtime = time.time() - tic
+        self.nr_decisions += nr_rows
+        self.runtime += runtime
+        set_fields(decisions_per_sec=round(nr_rows / max(runtime, 1e-9)))
+        count("rows", nr_rows)
+        count("predict_calls", self.nr_predict_calls - nr_predict_calls)
+        count("batched", self.nr_batched - nr_batched)
+        acts_gdf_mode["closest_station_origin"] = closest_origin
+        acts_gdf_mode["mode"] = final_modes
+        acts_gdf_mode["vehicle_no"] = final_veh_ids
+        acts_gdf_mode["start_station_no"] = final_start_station
+        acts_gdf_mode["end_station_no"] = final_end_station
+        # sort back
+        acts_gdf_mode.sort_values(["person_id", "activity_index"], inplace=True)
+        return acts_gdf_mode
+
+
+def assign_mode_events(
+    acts_gdf_mode,
+    station_scenario,
+    mode_choice_function,
+    batch_size=256,
+    station_candidates=None,
+    recorder=None,
+):
+    """
+    Event-based replacement for `assign_mode` with identical output. If a
+    recorder is given, all of its samples are filled after the simulation.
+    """
+    engine = EventEngine(
+        station_scenario,
+        mode_choice_function,
+        batch_size=batch_size,
+        recorder=recorder,
+    )
+    acts_gdf_mode = engine.run(
+        acts_gdf_mode, station_candidates=station_candidates
+    )
+    if recorder is not None:
+        engine.record_until()
+    return acts_gdf_mode
+
+
+def simulate_days(
+    acts_gdf_mode,
+    station_scenario,
+    mode_choice_function,
+    nr_days,
+    out_path,
+    batch_size=256,
+    station_candidates=None,
+    recorder=None,
+):
+    """
+    Simulate `nr_days` consecutive days in which every person follows the
+    same activity plan, with the state of the fleet carried across days.
+
+    The days are simulated one after the other with the same EventEngine, so
+    cars that are not returned at the end of a day stay borrowed and the
+    scheduled returns are processed on the next day. After each day, the
+    modes are appended to sim_modes.csv and the completed reservations to
+    sim_reservations.csv in out_path. Only the trips of bookings whose car is
+    still borrowed are kept in memory until the booking is completed.
+    Bookings that are still open at the end of the horizon are treated as
+    one-way trips by `derive_reservations`. If a recorder is given, it
+    records the occupancy over the whole horizon.
+    """
+    engine = EventEngine(
+        station_scenario,
+        mode_choice_function,
+        batch_size=batch_size,
+        recorder=recorder,
+    )
+    modes_path = os.path.join(out_path, "sim_modes.csv")
+    reservations_path = os.path.join(out_path, "sim_reservations.csv")
+    for path in [modes_path, reservations_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    nr_trips = len(acts_gdf_mode)
+    time_cols = [
+        col
+        for col in [
+            "mode_decision_time",
+            "started_at_origin",
+            "started_at_destination",
+        ]
+        if col in acts_gdf_mode.columns
+    ]
+    open_trips = None
+    for day in range(nr_days):
+        print("Simulating day", day)
+        day_trips = acts_gdf_mode.copy()
+        for col in time_cols:
+            day_trips[col] = day_trips[col] + pd.Timedelta(days=day)
+        day_trips["day"] = day
+        # the index identifies the reservations, so it must be unique
+        day_trips.index = pd.RangeIndex(day * nr_trips, (day + 1) * nr_trips)
+        day_trips = engine.run(
+            day_trips, station_candidates=station_candidates
+        )
+
+        day_trips[
+            [
+                "day",
+                "person_id",
+                "activity_index",
+                "mode_decision_time",
+                "mode",
+                "vehicle_no",
+            ]
+        ].to_csv(modes_path, mode="a", header=day == 0, index=False)
+
+        # only keep the car sharing trips of this day and the open bookings
+        day_trips = day_trips[day_trips["mode"] == CARSHARING_MODE]
+        if open_trips is not None:
+            day_trips = pd.concat([open_trips, day_trips]).sort_values(
+                ["person_id", "day", "activity_index"]
+            )
+        if day < nr_days - 1:
+            # a booking is open if the car was not returned at its last trip
+            # and the person still holds it
+            last_trip = booking_last_trip(day_trips)
+            is_open = (
+                day_trips["end_station_no"].values[last_trip] == -1
+            ) & day_trips["person_id"].isin(list(engine.borrowed)).values
+            open_trips = day_trips[is_open]
+            day_trips = day_trips[~is_open]
+        if len(day_trips) == 0:
+            continue
+        sim_reservations = derive_reservations(day_trips.copy())
+        sim_reservations.to_csv(
+            reservations_path,
+            mode="a",
+            header=not os.path.exists(reservations_path),
+        )
+    if recorder is not None:
+        engine.record_until()
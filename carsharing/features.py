@@ -1,13 +1,148 @@
+import os
 import pandas as pd
 import numpy as np
-import time
 import geopandas as gpd
-from datetime import timedelta
+from scipy.spatial import cKDTree
 
-from carsharing.utils import write_trips_csv
+from carsharing.weather import lookup_daily_weather
+from carsharing.accessibility import PTAccessibilityIndex
+from carsharing.profiling import profiled, span, count, set_fields
+from carsharing.utils import (
+    is_parquet,
+    read_trips_chunks,
+    write_trips,
+    write_trips_csv,
+)
 
 
-def compute_dist_to_station(trips, station):
+def updated_station_columns(trips, station, previous_station):
+    """
+    Closest stations and distances of trips that were computed for
+    previous_station, updated to a new station scenario. Only trips whose
+    closest station could change are re-evaluated: trips that were served by
+    a removed (or moved) station get the closest of all new stations, and
+    trips that are closer to an added station than to their current closest
+    station (i.e., that lie in the Voronoi cell of the added station) are
+    reassigned to it. The trips are not modified; returns a dictionary with
+    the new arrays of the closest_station_* and distance_to_station_*
+    columns.
+    """
+    assert trips.crs == station.crs, "Trips and stations must have the same CRS"
+    common = previous_station.index.intersection(station.index)
+    moved = common[
+        ~previous_station.loc[common, "geom"]
+        .geom_equals(station.loc[common, "geom"])
+        .values
+    ]
+    removed = previous_station.index.difference(station.index).union(moved)
+    added = station.index.difference(previous_station.index).union(moved)
+    station_xy = np.vstack([station["geom"].x.values, station["geom"].y.values]).T
+    added_xy = station_xy[station.index.get_indexer(added)]
+
+    columns = {}
+    for col in ["origin", "destination"]:
+        geoms = trips["geom_" + col]
+        trip_xy = np.vstack([geoms.x.values, geoms.y.values]).T
+        closest = trips["closest_station_" + col].values.copy()
+        distance = trips["distance_to_station_" + col].values.astype(float)
+
+        # trips that lost their station: closest of all new stations
+        lost = np.isin(closest, removed)
+        if np.any(lost):
+            dist_new, ind = cKDTree(station_xy).query(trip_xy[lost])
+            closest[lost] = station.index.values[ind]
+            distance[lost] = dist_new
+        # trips in the Voronoi cell of an added station
+        nr_closer = 0
+        if len(added) > 0:
+            dist_new, ind = cKDTree(added_xy).query(trip_xy)
+            closer = dist_new < distance
+            closest[closer] = added.values[ind[closer]]
+            distance[closer] = dist_new[closer]
+            nr_closer = np.sum(closer)
+        count("reassigned_" + col, np.sum(lost) + nr_closer)
+        print(
+            f"Reassigned {np.sum(lost) + nr_closer} of {len(trips)} trip",
+            col + "s",
+        )
+        columns["closest_station_" + col] = closest
+        columns["distance_to_station_" + col] = distance
+    return columns
+
+
+def update_dist_to_station(trips, station, previous_station):
+    """
+    Update the closest stations of trips that were computed for
+    previous_station to a new station scenario (see updated_station_columns)
+    """
+    for col, values in updated_station_columns(
+        trips, station, previous_station
+    ).items():
+        trips[col] = values
+    return trips
+
+
+def station_candidates_path(trips_path):
+    """Path of the station candidates that belong to a trips file"""
+    return os.path.splitext(trips_path)[0] + "_station_candidates.npz"
+
+
+def load_station_candidates(trips_path, station, k=8):
+    """
+    Station candidates that were saved with the features of a trips file
+    (see ModeChoiceFeatures.save), ordered like the rows of the file. Returns
+    None if there is no such file, or if it was computed for other stations
+    or with fewer than k candidates.
+    """
+    path = station_candidates_path(trips_path)
+    if not os.path.exists(path):
+        return None
+    k = min(k, len(station))
+    with np.load(path) as saved:
+        if "station" not in saved.files or saved["station_no"].shape[1] < k:
+            return None
+        same_stations = (
+            np.array_equal(saved["station"], station.index.values)
+            and np.allclose(saved["station_x"], station["geom"].x.values)
+            and np.allclose(saved["station_y"], station["geom"].y.values)
+        )
+        if not same_stations:
+            return None
+        return saved["station_no"][:, :k], saved["distance"][:, :k]
+
+
+def nearest_station_candidates(geoms, station, k=8):
+    """
+    Station numbers (int32) of the k closest stations of each geometry and
+    the distances to them (float32), ordered by distance
+    """
+    station_xy = np.vstack([station["geom"].x.values, station["geom"].y.values]).T
+    k = min(k, len(station))
+    distances, inds = cKDTree(station_xy).query(
+        np.vstack([geoms.x.values, geoms.y.values]).T, k=k
+    )
+    station_nos = station.index.values[inds.reshape(len(geoms), k)]
+    return (
+        station_nos.astype(np.int32),
+        distances.reshape(len(geoms), k).astype(np.float32),
+    )
+
+
+@profiled()
+def compute_dist_to_station(trips, station, previous_station=None):
+    """
+    Compute the closest station and the distance to it for the origin and
+    destination of each trip. If the trips already contain the closest
+    stations for previous_station, they are only updated (see
+    update_dist_to_station).
+    """
+    set_fields(
+        rows=len(trips),
+        stations=len(station),
+        update=previous_station is not None,
+    )
+    if previous_station is not None:
+        return update_dist_to_station(trips, station, previous_station)
     # delete columns if they already exist
     assert trips.crs == station.crs, "Trips and stations must have the same CRS"
     initial_crs = trips.crs
@@ -68,22 +203,14 @@ class ModeChoiceFeatures:
         col_name="purpose_destination",
         included_purposes=["home", "leisure", "work", "shopping", "education"],
     ):
-        occuring = self.trips[col_name].unique()
-        included_w_prefix = [
-            "feat_" + col_name + "_" + p for p in included_purposes
-        ]
-        included_and_occuring = [
-            p for p in included_w_prefix if p.split("_")[-1] in occuring
-        ]
-        one_hot = pd.get_dummies(
-            self.trips[col_name], prefix="feat_" + col_name
-        )[included_and_occuring]
-        for p in included_w_prefix:
-            if p not in included_and_occuring:
-                one_hot[p] = 0
-        self.trips = self.trips.merge(
-            one_hot, left_index=True, right_index=True
-        )
+        # one-hot encoding from the categorical codes (-1 for other purposes)
+        codes = pd.Categorical(
+            self.trips[col_name], categories=included_purposes
+        ).codes
+        for i, purpose in enumerate(included_purposes):
+            self.trips["feat_" + col_name + "_" + purpose] = (
+                codes == i
+            ).astype(int)
 
     def add_distance_feature(self):
         # add distance feature
@@ -97,57 +224,55 @@ class ModeChoiceFeatures:
         self,
         pt_accessibility,
         class_col="class",
-        origin_or_destination="origin",
+        origin_or_destination=None,
     ):
         """
         Arguments:
             pt_accessibility: GeoDataFrame with polygons as geometry and
-            corresponding accessibility class with column name class_col
+            corresponding accessibility class with column name class_col, or
+            a PTAccessibilityIndex (e.g. loaded with PTAccessibilityIndex.load)
             class_col: str, name of column with accessibility class (column must
             contain numeric values)
+            origin_or_destination: one of origin or destination, or None to
+            label both in one query
         """
-        self.trips = gpd.GeoDataFrame(
-            self.trips, geometry="geom_" + origin_or_destination
-        )
-        self.trips = self.trips.sjoin(pt_accessibility, how="left")
-        self.trips = self.trips.drop(["index_right"], axis=1).rename(
-            columns={class_col: "feat_pt_accessibility" + origin_or_destination}
-        )
-
-    def add_weather(self):
-        # import of meteostat here in order to remove the requirement
-        from meteostat import Hourly, Daily
-        from meteostat import Point as MeteoPoint
-
-        def get_daily_weather(row):
-            loc = MeteoPoint(
-                row["geom_destination"].y, row["geom_destination"].x
+        if not isinstance(pt_accessibility, PTAccessibilityIndex):
+            pt_accessibility = PTAccessibilityIndex(
+                pt_accessibility, class_col=class_col
             )
-            end = row["started_at_destination"].replace(tzinfo=None)
-            data = Daily(loc, end - timedelta(days=1, minutes=1), end).fetch()
-            if len(data) == 1:
-                return pd.Series(data.iloc[0])
-            else:
-                for random_testing in [100, 250, 500]:
-                    loc = MeteoPoint(
-                        row["geom_destination"].y,
-                        row["geom_destination"].x,
-                        random_testing,
-                    )
-                    data = Daily(loc, end - timedelta(days=1), end).fetch()
-                    if len(data) == 1:
-                        return pd.Series(data.iloc[0])
-                return pd.NA
+        origin_classes, destination_classes = pt_accessibility.lookup_trips(
+            self.trips
+        )
+        if origin_or_destination in [None, "origin"]:
+            self.trips["feat_pt_accessibilityorigin"] = origin_classes
+        if origin_or_destination in [None, "destination"]:
+            self.trips["feat_pt_accessibilitydestination"] = destination_classes
 
+    def add_weather(self, cell_size=0.1, cache_path=None, weather_table=None):
+        """
+        Add the daily weather at the destination of each trip. The weather
+        is looked up once per grid cell of cell_size degrees and day, from
+        a local weather_table or from meteostat (cached in cache_path, see
+        carsharing.weather.lookup_daily_weather)
+        """
         weather_input = self.trips[
             ["started_at_destination", "geom_destination"]
         ].dropna()
-        weather_input["geom_destination"] = weather_input[
-            "geom_destination"
-        ].to_crs("EPSG:4326")
-        weather_data = weather_input.apply(get_daily_weather, axis=1)
+        dest_geom = gpd.GeoSeries(
+            weather_input["geom_destination"], crs=self.initial_crs
+        ).to_crs("EPSG:4326")
+        weather_data = lookup_daily_weather(
+            dest_geom.x.values,
+            dest_geom.y.values,
+            weather_input["started_at_destination"],
+            cell_size=cell_size,
+            cache_path=cache_path,
+            weather_table=weather_table,
+        )
+        weather_data.index = weather_input.index
 
-        weather_data["prcp"] = weather_data["prcp"].fillna(0)
+        if "prcp" in weather_data.columns:
+            weather_data["prcp"] = weather_data["prcp"].fillna(0)
         weather_data.rename(
             columns={c: "feat_weather_" + c for c in weather_data.columns},
             inplace=True,
@@ -156,9 +281,17 @@ class ModeChoiceFeatures:
             weather_data, how="left", left_index=True, right_index=True
         )
 
-    def add_dist2station(self):
-        """Compute distance to next car sharing station"""
+    def add_dist2station(self, nr_candidates=0):
+        """
+        Compute distance to next car sharing station. With nr_candidates > 0,
+        the closest nr_candidates stations of each trip origin are stored as
+        well (used by the simulator if the closest station is empty)
+        """
         self.trips = compute_dist_to_station(self.trips, self.stations)
+        if nr_candidates > 0:
+            self.station_candidates = nearest_station_candidates(
+                self.trips["geom_origin"], self.stations, k=nr_candidates
+            )
 
         # use as features as well as for car sharing data generation
         for col in ["origin", "destination"]:
@@ -169,47 +302,43 @@ class ModeChoiceFeatures:
     def add_time_features(self, origin_or_destination="origin"):
         col_name = "started_at_" + origin_or_destination
         self.trips[col_name] = pd.to_datetime(self.trips[col_name])
+        # NaT gives NaN
         self.trips[f"feat_{origin_or_destination}_hour"] = self.trips[
             col_name
-        ].apply(lambda x: x.hour)
+        ].dt.hour
         self.trips[f"feat_{origin_or_destination}_day"] = self.trips[
             col_name
-        ].apply(lambda x: x.dayofweek if ~pd.isna(x) else print(x))
+        ].dt.dayofweek
 
     def fake_ht_ga_features(self):
         self.trips["feat_ga"] = 0
         self.trips["feat_halbtax"] = 0
 
-    def add_all_features(self, pt_accessibility_gdf=None):
-        tic = time.time()
-        self.add_distance_feature()
-        before_distance_0_removal = len(self.trips)
-        self.trips = self.trips[self.trips["feat_distance"] > 0]
-        print(
-            "Removed distance-0-trips (in %):",
-            1 - len(self.trips) / before_distance_0_removal,
-        )
-        print(time.time() - tic, "\nAdd purpose:")
-        tic = time.time()
-        self.add_purpose_features("purpose_destination")
-        self.add_purpose_features("purpose_origin")
+    @profiled()
+    def add_all_features(self, pt_accessibility_gdf=None, nr_candidates=0):
+        count("rows", len(self.trips))
+        with span("distance"):
+            self.add_distance_feature()
+            before_distance_0_removal = len(self.trips)
+            self.trips = self.trips[self.trips["feat_distance"] > 0]
+            set_fields(
+                removed_distance_0=before_distance_0_removal - len(self.trips)
+            )
+        with span("purpose", rows=len(self.trips)):
+            self.add_purpose_features("purpose_destination")
+            self.add_purpose_features("purpose_origin")
         if pt_accessibility_gdf is not None:
-            print(time.time() - tic, "\nAdd pt accessibility:")
-            tic = time.time()
-            self.add_pt_accessibility(origin_or_destination="origin")
-            self.add_pt_accessibility(origin_or_destination="destination")
+            with span("pt_accessibility", rows=len(self.trips)):
+                self.add_pt_accessibility(pt_accessibility_gdf)
         else:
             # model is trained on [0, 1, 2, 3, 4] where 0 is worst
             self.trips["feat_pt_accessibilitydestination"] = 1
             self.trips["feat_pt_accessibilityorigin"] = 1
-        print(time.time() - tic, "\nAdd dist2station:")
-        tic = time.time()
-        self.add_dist2station()
-        print(time.time() - tic, "\nAdd time:")
-        tic = time.time()
-        self.add_time_features(origin_or_destination="origin")
-        self.add_time_features(origin_or_destination="destination")
-        print(time.time() - tic)
+        with span("dist2station", rows=len(self.trips)):
+            self.add_dist2station(nr_candidates=nr_candidates)
+        with span("time", rows=len(self.trips)):
+            self.add_time_features(origin_or_destination="origin")
+            self.add_time_features(origin_or_destination="destination")
 
     def save(self, out_path, remove_geom=False):
         # remove geom (for more efficient saving)
@@ -219,5 +348,57 @@ class ModeChoiceFeatures:
             )
         else:
             out_trips = self.trips
-        write_trips_csv(out_trips, out_path)
+        write_trips(out_trips, out_path)
+        if hasattr(self, "station_candidates"):
+            # rows are in the same order as the rows of the trips file
+            station_nos, distances = self.station_candidates
+            # the stations are saved to check that they match when loading
+            np.savez(
+                station_candidates_path(out_path),
+                station_no=station_nos,
+                distance=distances,
+                station=self.stations.index.values,
+                station_x=self.stations["geom"].x.values,
+                station_y=self.stations["geom"].y.values,
+            )
 
+
+def add_features_chunked(
+    trips_path,
+    stations,
+    out_path,
+    chunksize=100000,
+    pt_accessibility_gdf=None,
+    remove_geom=False,
+    crs="EPSG:4326",
+):
+    """
+    Compute the features of the trips in a file chunk by chunk and append
+    each chunk to the output csv, so that the peak memory depends on the
+    chunk size and not on the number of trips. All feature steps only
+    depend on the trip itself, so the result is the same as with
+    ModeChoiceFeatures.add_all_features on all trips.
+    """
+    if is_parquet(out_path):
+        raise ValueError(
+            "Chunked feature computation writes csv files, convert to parquet afterwards"
+        )
+    if pt_accessibility_gdf is not None and not isinstance(
+        pt_accessibility_gdf, PTAccessibilityIndex
+    ):
+        # build the polygon index only once for all chunks
+        pt_accessibility_gdf = PTAccessibilityIndex(pt_accessibility_gdf)
+    mode, columns = "w", None
+    for chunk in read_trips_chunks(trips_path, chunksize=chunksize, crs=crs):
+        feat_collector = ModeChoiceFeatures(chunk, stations)
+        feat_collector.add_all_features(pt_accessibility_gdf=pt_accessibility_gdf)
+        out_trips = feat_collector.trips
+        if remove_geom:
+            out_trips = out_trips.drop(
+                [col for col in out_trips.columns if "geom" in col], axis=1
+            )
+        # the columns of all chunks must be in the same order
+        if columns is None:
+            columns = out_trips.columns
+        write_trips_csv(out_trips[columns], out_path, mode=mode)
+        mode = "a"
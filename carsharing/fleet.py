@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class FleetState:
+    """
+    State of the car sharing fleet in flat NumPy arrays.
+
+    The available vehicles of each station are kept as a stack in one
+    preallocated array: station i owns the slots
+    `stack_start[i]:stack_start[i] + capacity[i]`, of which the first
+    `nr_avail[i]` are occupied. Borrowing takes the vehicle on top of the
+    stack and returning puts it back on top (same order as appending to and
+    popping from a list), both in O(1). The capacity of a station is its
+    initial number of vehicles, since vehicles are returned to the station
+    where they were borrowed. `vehicle_station` holds the station position
+    of each vehicle (-1 while it is borrowed).
+    """
+
+    def __init__(self, vehicle_lists):
+        capacity = np.array([len(veh_list) for veh_list in vehicle_lists])
+        self.capacity = capacity
+        self.stack_start = np.concatenate([[0], np.cumsum(capacity)[:-1]])
+        self.nr_avail = capacity.copy()
+        self.stack = np.array(
+            [veh for veh_list in vehicle_lists for veh in veh_list],
+            dtype=np.int64,
+        )
+        self.vehicle_ids = self.stack.copy()
+        self.vehicle_index = {v: i for i, v in enumerate(self.vehicle_ids)}
+        self.vehicle_station = np.repeat(np.arange(len(capacity)), capacity)
+
+    def borrow(self, pos):
+        """Take the top vehicle from the station at position pos"""
+        self.nr_avail[pos] -= 1
+        vehicle = self.stack[self.stack_start[pos] + self.nr_avail[pos]]
+        self.vehicle_station[self.vehicle_index[vehicle]] = -1
+        return vehicle
+
+    def return_vehicle(self, pos, vehicle):
+        """Put a vehicle back on the station at position pos"""
+        if self.nr_avail[pos] >= self.capacity[pos]:
+            raise RuntimeError(
+                f"Vehicle {vehicle} returned to a full station at position {pos}"
+            )
+        self.stack[self.stack_start[pos] + self.nr_avail[pos]] = vehicle
+        self.nr_avail[pos] += 1
+        self.vehicle_station[self.vehicle_index[vehicle]] = pos
+
+    def snapshot(self):
+        """Copy of the vehicles per station and the station of each vehicle"""
+        return self.nr_avail.copy(), self.vehicle_station.copy()
+
+    def available_vehicles(self, pos):
+        """Vehicle IDs that are currently available at a station"""
+        start = self.stack_start[pos]
+        return self.stack[start : start + self.nr_avail[pos]].tolist()
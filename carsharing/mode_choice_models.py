@@ -1,13 +1,38 @@
 import os
 import numpy as np
+import pandas as pd
 import xgboost as xgb
 import pickle
+from abc import ABC, abstractmethod
 from sklearn.metrics import balanced_accuracy_score
 from sklearn.ensemble import RandomForestClassifier
 from carsharing.plotting import plot_confusion_matrix
 
 
-class BasicModeChoice:
+class ModeChoiceModel(ABC):
+    """
+    Interface of the mode choice models
+
+    Calling a model with one row of features (pd.Series) returns the chosen
+    mode. `predict_modes` scores a whole feature table (pd.DataFrame) at once
+    and returns an array with one mode per row. Random draws are taken from
+    `rng` (a np.random.Generator), or from the global numpy random state if
+    no generator is given.
+    """
+
+    # whether rows can be predicted in batches in the simulation (only if the
+    # predictions are deterministic)
+    batch_inference = False
+
+    def __call__(self, feature_vec):
+        return self.predict_modes(pd.DataFrame([feature_vec]))[0]
+
+    @abstractmethod
+    def predict_modes(self, features, rng=None):
+        pass
+
+
+class BasicModeChoice(ModeChoiceModel):
     """basic mode choice model based on the distance"""
     def __call__(self, feature_vec):
         distance = feature_vec["distance"]
@@ -18,6 +43,13 @@ class BasicModeChoice:
             return "Mode::CarsharingMobility"
         return "Mode::Car"
 
+    def predict_modes(self, features, rng=None):
+        distance = features["distance"].values
+        distance_to_station = features["distance_to_station_origin"].values
+        draws = np.random.rand(len(features)) if rng is None else rng.random(len(features))
+        is_shared = (distance >= 2 * distance_to_station) & (draws < 0.1)
+        return np.where(is_shared, "Mode::CarsharingMobility", "Mode::Car").astype(object)
+
 
 def rf_tuning(X_train, X_test, y_train, y_test, max_depth=None, plot_confusion=False, out_path=None):
     rf = RandomForestClassifier(max_depth=max_depth)
@@ -32,7 +64,10 @@ def rf_tuning(X_train, X_test, y_train, y_test, max_depth=None, plot_confusion=F
     return car_sharing_acc
 
 
-class RandomForestWrapper:
+class RandomForestWrapper(ModeChoiceModel):
+    # predictions are deterministic, so rows can be predicted in batches
+    batch_inference = True
+
     def __init__(self, max_depth=20) -> None:
         self.rf = xgb.XGBClassifier(max_depth=max_depth)
         # self.rf = RandomForestClassifier(max_depth=max_depth)
@@ -46,18 +81,91 @@ class RandomForestWrapper:
         #     feature_vec = pd.DataFrame(feature_vec).T
 
         # select only the relevant feature columns
-        feature_vec = np.array(feature_vec[self.feat_columns])
-        # expand dims in case it's only one row
         if len(feature_vec.shape) < 2:
-            feature_vec = feature_vec.reshape(1, -1)
-        # predict
-        pred_label = self.rf.predict(feature_vec)
-        pred_label_str = self.label_meanings[pred_label]
+            # single row: copy the features into a preallocated buffer
+            positions = self._feature_positions(feature_vec.index)
+            feature_arr = self._row_buffer()
+            feature_arr[0] = feature_vec.values[positions]
+            return self.label_meanings[self._predict(feature_arr)][0]
+        pred_label_str = self.predict_modes(feature_vec)
         if len(pred_label_str) == 1:
             # if it's only one row, we return only the String, not an array
             return pred_label_str[0]
         return pred_label_str
 
+    def predict_modes(self, features, rng=None):
+        """Predicted modes of all rows (deterministic, rng is not used)"""
+        if not hasattr(self, "feat_columns"):
+            raise RuntimeError("Forest must first be fitted!")
+        positions = self._feature_positions(features.columns)
+        feature_arr = features.iloc[:, positions].to_numpy(dtype=np.float32)
+        return self.label_meanings[self._predict(feature_arr)]
+
+    def _feature_positions(self, columns):
+        """
+        Positions of the feature columns in the given columns (cached for the
+        last columns object, so repeated calls with rows of the same table
+        do not look up the column names again)
+        """
+        cache = self.__dict__.setdefault("_inference_cache", {})
+        if cache.get("columns") is not columns:
+            positions = pd.Index(columns).get_indexer(self.feat_columns)
+            if np.any(positions < 0):
+                missing = np.asarray(self.feat_columns)[positions < 0]
+                raise KeyError(f"Missing feature columns {list(missing)}")
+            cache["columns"], cache["positions"] = columns, positions
+        return cache["positions"]
+
+    def _row_buffer(self):
+        cache = self.__dict__.setdefault("_inference_cache", {})
+        if "row_buffer" not in cache:
+            cache["row_buffer"] = np.empty(
+                (1, len(self.feat_columns)), dtype=np.float32
+            )
+        return cache["row_buffer"]
+
+    def _predict(self, feature_arr):
+        """
+        Predicted class indices, using the booster directly (skips the input
+        validation and conversion of XGBClassifier.predict)
+        """
+        if not hasattr(self.rf, "get_booster"):
+            return self.rf.predict(feature_arr)
+        probs = self.rf.get_booster().inplace_predict(
+            feature_arr,
+            iteration_range=self._iteration_range(),
+            missing=self.rf.missing,
+            validate_features=False,
+        )
+        # same post-processing as XGBClassifier.predict
+        if len(probs.shape) > 1 and self.rf.n_classes_ != 2:
+            # multi-class probabilities
+            return np.argmax(probs, axis=1)
+        if len(probs.shape) > 1:
+            # two columns with two classes (multi-label output)
+            return self.rf.predict(feature_arr)
+        if self.rf.objective == "multi:softmax":
+            # the output are the class indices already
+            return probs.astype(np.int32)
+        # binary classification
+        return (probs > 0.5).astype(int)
+
+    def _iteration_range(self):
+        """Trees used for prediction (up to best_iteration if it was set)"""
+        get_range = getattr(self.rf, "_get_iteration_range", None)
+        if get_range is not None:
+            return get_range(None)
+        try:
+            return (0, self.rf.best_iteration + 1)
+        except AttributeError:
+            return (0, 0)
+
+    def __getstate__(self):
+        # the inference cache is not saved
+        state = self.__dict__.copy()
+        state.pop("_inference_cache", None)
+        return state
+
     def fit(self, features, labels):
         self.feat_columns = features.columns
         self.label_meanings = np.array(labels.columns)
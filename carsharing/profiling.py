@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import functools
+from contextlib import contextmanager
+import pandas as pd
+
+
+class Span:
+    """A named stage of the pipeline with additional fields and counters"""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = dict(fields)
+        self.counters = {}
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+class Profiler:
+    """
+    Structured instrumentation of the pipeline stages.
+
+    A span measures the wall-clock time of a named stage. Spans can be
+    nested, and the name of a nested span is prefixed with the name of its
+    parent (e.g. "add_all_features.purpose"). Counters such as the number of
+    rows or of calls to the mode choice model are added to all open spans,
+    and further fields can be set on the innermost span. When a span ends,
+    one record is written as a JSON line with the run ID, process ID, span
+    name, start time, duration (in seconds), fields and counters. By default
+    the records are printed, after `enable` they are appended to a file.
+    """
+
+    def __init__(self):
+        # the printed records are labelled with the start time as well
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+        self.out_file = None
+        self.spans = []
+
+    def enable(self, out_path, run_id=None):
+        """Append the records to a JSON lines file, labelled with run_id"""
+        self.disable()
+        self.out_file = open(out_path, "a", buffering=1)
+        self.run_id = (
+            run_id if run_id is not None else time.strftime("%Y%m%d-%H%M%S")
+        )
+
+    def disable(self):
+        if self.out_file is not None:
+            self.out_file.close()
+        self.out_file = None
+
+    @contextmanager
+    def span(self, name, **fields):
+        if self.spans:
+            name = self.spans[-1].name + "." + name
+        current = Span(name, fields)
+        self.spans.append(current)
+        start, tic = time.time(), time.perf_counter()
+        try:
+            yield current
+        except BaseException as e:
+            current.set(error=type(e).__name__)
+            raise
+        finally:
+            duration = time.perf_counter() - tic
+            self.spans.pop()
+            self.write(current, start, duration)
+
+    def count(self, name, value=1):
+        for span in self.spans:
+            span.count(name, value)
+
+    def set(self, **fields):
+        if self.spans:
+            self.spans[-1].set(**fields)
+
+    def write(self, span, start, duration):
+        record = {
+            "run": self.run_id,
+            "pid": os.getpid(),
+            "span": span.name,
+            "start": round(start, 3),
+            "duration": round(duration, 6),
+            **span.fields,
+            **span.counters,
+        }
+        line = json.dumps(record, default=_to_json)
+        if self.out_file is None:
+            print(line)
+        else:
+            self.out_file.write(line + "\n")
+
+
+def _to_json(value):
+    # numpy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+PROFILER = Profiler()
+span = PROFILER.span
+count = PROFILER.count
+set_fields = PROFILER.set
+enable = PROFILER.enable
+disable = PROFILER.disable
+
+# enable the output file for all scripts with an environment variable
+if os.environ.get("CARSHARING_PROFILE"):
+    enable(
+        os.environ["CARSHARING_PROFILE"], os.environ.get("CARSHARING_RUN_ID")
+    )
+
+
+def profiled(name=None):
+    """Decorator that runs a function in a span (default: function name)"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def read_profiles(paths):
+    """
+    Read the records of one or several JSON lines files into a dataframe.
+    Other lines are skipped, so that captured stdout can be read as well.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    records = []
+    for path in paths:
+        with open(path, "r") as infile:
+            records.extend(
+                json.loads(line)
+                for line in infile
+                if line.startswith('{"run": ')
+            )
+    return pd.DataFrame(records)
+
+
+def compare_runs(profiles, value="duration"):
+    """
+    Table with one row per span and one column per run, with the sum of
+    `value` (e.g. duration or a counter) over all records of the span
+    """
+    return (
+        profiles.groupby(["span", "run"], sort=False, dropna=False)[value]
+        .sum()
+        .unstack("run")
+    )
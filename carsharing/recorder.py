@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+
+class OccupancyRecorder:
+    """
+    Records the number of available vehicles per station at fixed intervals
+    during the simulation.
+
+    The counts are written into a preallocated (time x station) array, so
+    recording does not allocate memory during the simulation. The engine
+    only compares the decision time with `next_time` and calls `record` when
+    a sample is due. Decisions whose closest station is empty are counted
+    per interval with `count_fallback` (a further station was used) and
+    `count_no_vehicle` (no station had a vehicle); the counts of slot k
+    belong to the decisions between the samples k - 1 and k.
+    """
+
+    def __init__(self, station_nos, start_time, end_time, interval="15min"):
+        self.station_nos = np.asarray(station_nos)
+        self.interval = pd.Timedelta(interval).value
+        self.start_time = pd.Timestamp(start_time).floor(interval).value
+        end_time = pd.Timestamp(end_time).value
+        nr_slots = (
+            int(np.ceil((end_time - self.start_time) / self.interval)) + 1
+        )
+        self.available = np.full(
+            (nr_slots, len(self.station_nos)), -1, dtype=np.int16
+        )
+        self.fallbacks = np.zeros(nr_slots, dtype=np.int32)
+        self.no_vehicle = np.zeros(nr_slots, dtype=np.int32)
+        self.slot = 0
+        # time of the next sample (int64 ns, max. int64 when all are filled)
+        self.next_time = self.start_time
+
+    @property
+    def nr_slots(self):
+        return len(self.available)
+
+    def record(self, nr_avail):
+        """Store the counts for the current sample and move to the next one"""
+        self.available[self.slot] = nr_avail
+        self.slot += 1
+        if self.slot < self.nr_slots:
+            self.next_time += self.interval
+        else:
+            self.next_time = np.iinfo(np.int64).max
+
+    def count_fallback(self):
+        self.fallbacks[min(self.slot, self.nr_slots - 1)] += 1
+
+    def count_no_vehicle(self):
+        self.no_vehicle[min(self.slot, self.nr_slots - 1)] += 1
+
+    def times(self):
+        return pd.to_datetime(
+            self.start_time + self.interval * np.arange(self.nr_slots)
+        )
+
+    def save(self, out_path):
+        """Save all arrays in one compressed numpy file (.npz)"""
+        np.savez_compressed(
+            out_path,
+            times=self.times().values,
+            station_no=self.station_nos,
+            available=self.available,
+            fallbacks=self.fallbacks,
+            no_vehicle=self.no_vehicle,
+        )
+
+    def to_frame(self):
+        """Available vehicles as a dataframe (time x station)"""
+        return pd.DataFrame(
+            self.available, index=self.times(), columns=self.station_nos
+        )
@@ -0,0 +1,112 @@
+import heapq
+import math
+import numpy as np
+
+
+class AvailableStationIndex:
+    """
+    Dynamic nearest-neighbour index over the station coordinates.
+
+    The stations are stored in a static, balanced kd-tree. Each node keeps
+    the number of available stations in its subtree, so that stations can be
+    switched on (a car came back to an empty station) or off (the last car
+    left the station) in O(log n), and the nearest available station is
+    found by a best-first search that skips subtrees without any available
+    station. Ties are broken by the position of the station, like `idxmin`
+    on the station table.
+    """
+
+    def __init__(self, x, y, available=None, leaf_size=8):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        nr_stations = len(self.x)
+        if available is None:
+            available = np.ones(nr_stations, dtype=bool)
+        # python lists are faster than arrays for single-element access
+        self.available = np.asarray(available, dtype=bool).tolist()
+        self._x, self._y = self.x.tolist(), self.y.tolist()
+
+        # tree nodes: station positions (leaves), children, bounding boxes
+        self.node_stations = []
+        self.node_children = []
+        self.node_bbox = []
+        self.node_parent = []
+        self.leaf_of = [0] * nr_stations
+        self._build(np.arange(nr_stations), -1, leaf_size)
+        self.node_count = [0] * len(self.node_parent)
+        for pos in np.flatnonzero(self.available):
+            self._update_count(pos, 1)
+
+    def _build(self, positions, parent, leaf_size):
+        node = len(self.node_parent)
+        self.node_parent.append(parent)
+        self.node_children.append(())
+        self.node_stations.append(())
+        if len(positions) == 0:
+            self.node_bbox.append((np.inf, np.inf, -np.inf, -np.inf))
+            return node
+        xs, ys = self.x[positions], self.y[positions]
+        self.node_bbox.append(
+            (float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()))
+        )
+        if len(positions) <= leaf_size:
+            self.node_stations[node] = tuple(positions.tolist())
+            for pos in self.node_stations[node]:
+                self.leaf_of[pos] = node
+            return node
+        # split at the median of the dimension with the larger spread
+        coords = xs if xs.max() - xs.min() >= ys.max() - ys.min() else ys
+        order = np.argsort(coords, kind="stable")
+        half = len(positions) // 2
+        left = self._build(positions[order[:half]], node, leaf_size)
+        right = self._build(positions[order[half:]], node, leaf_size)
+        self.node_children[node] = (left, right)
+        return node
+
+    def _update_count(self, pos, change):
+        node = self.leaf_of[pos]
+        while node >= 0:
+            self.node_count[node] += change
+            node = self.node_parent[node]
+
+    def set_available(self, pos, available):
+        """Switch a station (by position) on or off"""
+        if self.available[pos] == available:
+            return
+        self.available[pos] = available
+        self._update_count(pos, 1 if available else -1)
+
+    def _min_dist2(self, node, qx, qy):
+        min_x, min_y, max_x, max_y = self.node_bbox[node]
+        dx = max(min_x - qx, 0, qx - max_x)
+        dy = max(min_y - qy, 0, qy - max_y)
+        return dx * dx + dy * dy
+
+    def nearest(self, qx, qy):
+        """
+        Position of and distance to the nearest available station, or
+        (-1, inf) if no station is available
+        """
+        best_pos, best_d2 = -1, math.inf
+        if self.node_count[0] == 0:
+            return best_pos, best_d2
+        queue = [(self._min_dist2(0, qx, qy), 0)]
+        while queue:
+            min_d2, node = heapq.heappop(queue)
+            if min_d2 > best_d2:
+                break
+            if self.node_stations[node]:
+                for pos in self.node_stations[node]:
+                    if not self.available[pos]:
+                        continue
+                    dx, dy = self._x[pos] - qx, self._y[pos] - qy
+                    d2 = dx * dx + dy * dy
+                    if d2 < best_d2 or (d2 == best_d2 and pos < best_pos):
+                        best_pos, best_d2 = pos, d2
+                continue
+            for child in self.node_children[node]:
+                if self.node_count[child] > 0:
+                    heapq.heappush(
+                        queue, (self._min_dist2(child, qx, qy), child)
+                    )
+        return best_pos, math.sqrt(best_d2)
@@ -1,13 +1,48 @@
 import os
-import time
 import pickle
 import pandas as pd
 import numpy as np
 import geopandas as gpd
 from shapely import wkt
+from scipy.spatial import cKDTree
 
+from carsharing.utils import is_parquet
+from carsharing.profiling import profiled, span, count, set_fields
 
-def station_placement_kmeans(X, k, fixed_stations, max_iters=50):
+
+def assign_to_centroids(X, centroids, block_size=2**18, n_jobs=-1):
+    """
+    Index of the closest centroid for each row of X (first one if tied)
+
+    The rows are processed in blocks (to bound the memory) with a KD-tree over
+    the centroids, which is queried by n_jobs threads (-1: all cores). Rows
+    where the two closest centroids are (almost) equally far are resolved
+    with the exact squared distances, so that the result is the same as the
+    argmin over the distances to all centroids.
+    """
+    labels = np.zeros(len(X), dtype=np.int64)
+    if len(centroids) < 2:
+        return labels
+    tree = cKDTree(centroids)
+    for start in range(0, len(X), block_size):
+        block = X[start : start + block_size]
+        dists, inds = tree.query(block, k=2, workers=n_jobs)
+        block_labels = inds[:, 0]
+        ambiguous = np.flatnonzero(
+            dists[:, 1] - dists[:, 0] <= 1e-9 * dists[:, 1]
+        )
+        if len(ambiguous) > 0:
+            exact_dists = np.sum(
+                (block[ambiguous, np.newaxis, :] - centroids) ** 2, axis=2
+            )
+            block_labels[ambiguous] = np.argmin(exact_dists, axis=1)
+        labels[start : start + block_size] = block_labels
+    return labels
+
+
+@profiled()
+def station_placement_kmeans(X, k, fixed_stations, max_iters=50, n_jobs=-1):
+    X = np.asarray(X)
     x_df = pd.DataFrame(X)
     diff = 1
     cluster = np.zeros(X.shape[0])
@@ -19,13 +54,10 @@ def station_placement_kmeans(X, k, fixed_stations, max_iters=50):
         centroids = np.concatenate(
             (fixed_stations, centroids_not_fixed), axis=0
         )
-        # for each observation
-        tic = time.time()
-        for i, row in enumerate(X):
-            dists = np.sum((centroids - row) ** 2, axis=1)
-            cluster[i] = np.argmin(dists)
-            is_not_fixed[i] = cluster[i] >= fixed_centroid_nr
-        print(f"Finished iteration {iters} of KMeans, time:", time.time() - tic)
+        # assign each observation to the closest centroid
+        with span("assign", iteration=iters, rows=len(X)):
+            cluster[:] = assign_to_centroids(X, centroids, n_jobs=n_jobs)
+        is_not_fixed = cluster >= fixed_centroid_nr
 
         fixed_indicator = is_not_fixed.astype(bool)
         new_centroids = (
@@ -59,6 +91,7 @@ def station_placement_kmeans(X, k, fixed_stations, max_iters=50):
             centroids_not_fixed = new_centroids
         iters += 1
 
+    set_fields(iterations=iters, converged=not diff)
     return centroids, cluster
 
 
@@ -97,6 +130,129 @@ def place_new_stations(
     return new_stations_gdf
 
 
+def read_origin_chunks(trips_path, chunksize=100000, geom_col="geom_origin"):
+    """
+    Read the trip origins from a trips file (csv or parquet) as arrays of
+    (x, y) in chunks
+    """
+    if is_parquet(trips_path):
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(trips_path).iter_batches(
+            batch_size=chunksize, columns=[geom_col]
+        )
+        for batch in batches:
+            wkb = batch.column(geom_col).drop_null()
+            geoms = gpd.GeoSeries.from_wkb(wkb.to_numpy(zero_copy_only=False))
+            yield np.vstack([geoms.x.values, geoms.y.values]).swapaxes(1, 0)
+        return
+    for chunk in pd.read_csv(
+        trips_path, usecols=[geom_col], chunksize=chunksize
+    ):
+        geoms = gpd.GeoSeries.from_wkt(chunk[geom_col].dropna())
+        yield np.vstack([geoms.x.values, geoms.y.values]).swapaxes(1, 0)
+
+
+@profiled()
+def station_placement_minibatch(
+    trips_path,
+    k,
+    fixed_stations,
+    chunksize=100000,
+    batch_size=10000,
+    n_epochs=3,
+):
+    """
+    Mini-batch version of station_placement_kmeans for large populations
+
+    The trip origins are streamed from the file (csv or parquet) in chunks,
+    and the non-fixed centroids are updated after each batch of points with a
+    per-centroid learning rate of 1 / (number of points assigned so far).
+    Points that are closest to a fixed station do not move any centroid.
+    Centroids that did not get any point during one pass over the data are
+    reinitialized.
+    """
+    fixed_centroid_nr = len(fixed_stations)
+    centroids_not_fixed = None
+    counts = np.zeros(k)
+    for epoch in range(n_epochs):
+        epoch_counts = np.zeros(k)
+        with span("epoch", epoch=epoch):
+            for X in read_origin_chunks(trips_path, chunksize=chunksize):
+                if centroids_not_fixed is None:
+                    init_inds = np.random.choice(
+                        len(X), k, replace=len(X) < k
+                    )
+                    centroids_not_fixed = X[init_inds].astype(float)
+                count("rows", len(X))
+                X = X[np.random.permutation(len(X))]
+                for start in range(0, len(X), batch_size):
+                    batch = X[start : start + batch_size]
+                    centroids = np.concatenate(
+                        (fixed_stations, centroids_not_fixed), axis=0
+                    )
+                    cluster = assign_to_centroids(batch, centroids)
+                    is_not_fixed = cluster >= fixed_centroid_nr
+                    cluster = cluster[is_not_fixed] - fixed_centroid_nr
+                    batch = batch[is_not_fixed]
+                    # move each centroid towards the mean of its points
+                    batch_counts = np.bincount(cluster, minlength=k)
+                    batch_sums = np.stack(
+                        [
+                            np.bincount(
+                                cluster, weights=batch[:, d], minlength=k
+                            )
+                            for d in range(2)
+                        ],
+                        axis=1,
+                    )
+                    counts += batch_counts
+                    epoch_counts += batch_counts
+                    upd = batch_counts > 0
+                    centroids_not_fixed[upd] += (
+                        batch_sums[upd]
+                        - batch_counts[upd, np.newaxis]
+                        * centroids_not_fixed[upd]
+                    ) / counts[upd, np.newaxis]
+
+        # if some centroids got lost (no population assigned), reinitialize
+        lost = np.flatnonzero(epoch_counts == 0)
+        if len(lost) > 0 and epoch < n_epochs - 1:
+            centroids_not_fixed[lost] = X[np.random.choice(len(X), len(lost))]
+            counts[lost] = 0
+            print("reinitialize stations", len(lost))
+
+    return np.concatenate((fixed_stations, centroids_not_fixed), axis=0)
+
+
+def place_new_stations_minibatch(
+    nr_new_stations,
+    trips_path,
+    station_locations,
+    chunksize=100000,
+    n_epochs=3,
+):
+    """Like place_new_stations, but streams the trips from the file"""
+    centroids = station_placement_minibatch(
+        trips_path,
+        nr_new_stations,
+        station_locations,
+        chunksize=chunksize,
+        n_epochs=n_epochs,
+    )
+    # assert that the fixed stations remain the same
+    assert np.all(centroids[: len(station_locations)] == station_locations)
+    new_stations_gdf = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy(
+            x=centroids[len(station_locations) :, 0],
+            y=centroids[len(station_locations) :, 1],
+        )
+    )
+    new_stations_gdf.rename({"geometry": "geom"}, axis=1, inplace=True)
+    new_stations_gdf.index.name = "station_no"
+    return new_stations_gdf
+
+
 def place_vehicles(stations, mode="one_per_station"):
     if mode == "one_per_station":
         veh = pd.Series([[i] for i in range(len(stations))])
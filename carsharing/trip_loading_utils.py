@@ -1,50 +1,153 @@
+import io
 import os
-import xmltodict
+import gzip
+import numpy as np
+import xml.etree.ElementTree as ET
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import geopandas as gpd
 
+# columns of the activities that are read from a population file
+ACTIVITY_COLUMNS = [
+    "person_id",
+    "feat_sex",
+    "feat_age",
+    "feat_employed",
+    "feat_caraccess",
+    "activity_index",
+    "purpose",
+    "location_id",
+    "started_at",
+    "x",
+    "y",
+]
 
-def xml_to_activities(xml_path, crs="EPSG:4326"):
-    with open(xml_path, "r") as myfile:
-        obj = xmltodict.parse(myfile.read())
-
-    out_dict = defaultdict(list)
-
-    for entry in obj["population"]["person"]:
-        if isinstance(entry["plan"]["act"], list):
-            prev_end_time = "00:00:00"
-            for i, act in enumerate(entry["plan"]["act"]):
-                if "@x" not in act.keys():
-                    continue
-                out_dict["person_id"].append(entry["@id"])
-                out_dict["feat_sex"].append(entry["@sex"])
-                out_dict["feat_age"].append(entry["@age"])
-                out_dict["feat_employed"].append(entry["@employed"])
-                out_dict["feat_caraccess"].append(entry["@car_avail"])
-                out_dict["activity_index"].append(i)
-                out_dict["purpose"].append(act["@type"])
-                out_dict["location_id"].append(act["@facility"])
-                # add start time
-                if "@start_time" in act.keys():
-                    out_dict["started_at"].append(act["@start_time"])
-                else:
-                    out_dict["started_at"].append(prev_end_time)
-                # update prev end time
-                if "@end_time" in act.keys():
-                    prev_end_time = act["@end_time"]
-                out_dict["x"].append(act["@x"])
-                out_dict["y"].append(act["@y"])
-    out_df = pd.DataFrame(out_dict)
+
+def iter_persons(xml_path, byte_range=None):
+    """
+    Iterate over the <person> elements of a MATSim population file (plain or
+    gzipped) one at a time. Each element is cleared after it was processed,
+    so the memory does not grow with the size of the file.
+    If byte_range=(start, end) is given, only the persons in this part of the
+    (uncompressed) file are parsed (see find_person_shards).
+    """
+    if byte_range is None:
+        opener = gzip.open if xml_path.endswith(".gz") else open
+        infile = opener(xml_path, "rb")
+    else:
+        start, end = byte_range
+        with open(xml_path, "rb") as f:
+            f.seek(start)
+            shard = f.read(end - start)
+        infile = io.BytesIO(b"<population>" + shard + b"</population>")
+    with infile:
+        context = ET.iterparse(infile, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event == "end" and elem.tag == "person":
+                yield elem
+                elem.clear()
+                root.clear()
+
+
+def _person_to_activities(person, out_dict):
+    """Append the activities of one person to the column buffers"""
+    plans = person.findall("plan")
+    if len(plans) == 0:
+        return
+    # use the selected plan
+    plan = next((p for p in plans if p.get("selected") == "yes"), plans[0])
+    acts = plan.findall("act")
+    if len(acts) < 2:
+        return
+    prev_end_time = "00:00:00"
+    for i, act in enumerate(acts):
+        if act.get("x") is None:
+            continue
+        out_dict["person_id"].append(person.get("id"))
+        out_dict["feat_sex"].append(person.get("sex"))
+        out_dict["feat_age"].append(person.get("age"))
+        out_dict["feat_employed"].append(person.get("employed"))
+        out_dict["feat_caraccess"].append(person.get("car_avail"))
+        out_dict["activity_index"].append(i)
+        out_dict["purpose"].append(act.get("type"))
+        out_dict["location_id"].append(act.get("facility"))
+        # add start time
+        out_dict["started_at"].append(act.get("start_time", prev_end_time))
+        # update prev end time
+        prev_end_time = act.get("end_time", prev_end_time)
+        out_dict["x"].append(float(act.get("x")))
+        out_dict["y"].append(float(act.get("y")))
+
+
+def _buffers_to_gdf(out_dict, crs):
+    out_df = pd.DataFrame(out_dict, columns=ACTIVITY_COLUMNS)
+    out_df["activity_index"] = out_df["activity_index"].astype(np.int64)
     # transform to gdf
     out_df = gpd.GeoDataFrame(
         out_df,
-        geometry=gpd.points_from_xy(x=out_df["x"], y=out_df["y"]),
+        geometry=gpd.points_from_xy(
+            x=out_df["x"].astype(float), y=out_df["y"].astype(float)
+        ),
         crs=crs,
     ).drop(["x", "y"], axis=1)
     return out_df
 
 
+def iter_activity_chunks(
+    xml_path, chunk_size=10000, crs="EPSG:4326", byte_range=None
+):
+    """
+    Stream the activities from a MATSim population file in chunks of
+    chunk_size persons (all activities of a person are in the same chunk)
+    """
+    out_dict, nr_persons = defaultdict(list), 0
+    for person in iter_persons(xml_path, byte_range=byte_range):
+        _person_to_activities(person, out_dict)
+        nr_persons += 1
+        if nr_persons == chunk_size:
+            yield _buffers_to_gdf(out_dict, crs)
+            out_dict, nr_persons = defaultdict(list), 0
+    if nr_persons > 0:
+        yield _buffers_to_gdf(out_dict, crs)
+
+
+def xml_to_activities(xml_path, crs="EPSG:4326", byte_range=None):
+    chunks = list(
+        iter_activity_chunks(xml_path, crs=crs, byte_range=byte_range)
+    )
+    if len(chunks) == 0:
+        return _buffers_to_gdf(defaultdict(list), crs)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def xml_to_trips_chunked(
+    xml_path, out_path, chunk_size=10000, crs="EPSG:4326"
+):
+    """
+    Convert a MATSim population file into a trips csv chunk by chunk, so that
+    the peak memory does not depend on the size of the population. The
+    trips are grouped by person in the order of the population file.
+    """
+    from carsharing.utils import is_parquet, write_trips_csv
+
+    if is_parquet(out_path):
+        raise ValueError(
+            "Chunked conversion writes csv files, convert to parquet afterwards"
+        )
+    mode = "w"
+    chunks = iter_activity_chunks(xml_path, chunk_size=chunk_size, crs=crs)
+    for act_df in chunks:
+        # empty chunks are written as well (the header is always written)
+        write_trips_csv(activities_to_trips(act_df), out_path, mode=mode)
+        mode = "a"
+    if mode == "w":
+        # no persons in the file
+        act_df = _buffers_to_gdf(defaultdict(list), crs)
+        write_trips_csv(activities_to_trips(act_df), out_path, mode=mode)
+
+
 def activities_to_trips(act_df):
     act_df.sort_values(["person_id", "activity_index"], inplace=True)
     act_df["geom_origin"] = act_df["geometry"].shift(1)
@@ -76,3 +179,74 @@ def activities_to_trips(act_df):
     return act_df
 
 
+
+
+def find_person_shards(xml_path, nr_shards, block_size=2**20):
+    """
+    Split an (uncompressed) population file into at most nr_shards byte
+    ranges (start, end) of roughly equal size. Each range starts at a
+    <person> element and contains only complete persons.
+    """
+    if xml_path.endswith(".gz"):
+        raise ValueError("Sharding requires an uncompressed population file")
+
+    def find_next(f, pattern, offset):
+        # offset of the next occurrence of pattern after offset (or -1)
+        f.seek(offset)
+        overlap = b""
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return -1
+            found = (overlap + block).find(pattern)
+            if found >= 0:
+                return offset - len(overlap) + found
+            overlap = block[-len(pattern) :]
+            offset += len(block)
+
+    file_size = os.path.getsize(xml_path)
+    with open(xml_path, "rb") as f:
+        starts = [find_next(f, b"<person ", 0)]
+        if starts[0] < 0:
+            return []
+        for k in range(1, nr_shards):
+            start = find_next(f, b"<person ", k * file_size // nr_shards)
+            if start > starts[-1]:
+                starts.append(start)
+        # the last shard ends with the population
+        f.seek(max(0, file_size - block_size))
+        tail = f.read()
+        end = file_size - len(tail) + tail.rfind(b"</population>")
+    return list(zip(starts, starts[1:] + [end]))
+
+
+def _shard_to_trips(args):
+    xml_path, byte_range, crs = args
+    act_df = xml_to_activities(xml_path, crs=crs, byte_range=byte_range)
+    return activities_to_trips(act_df)
+
+
+def xml_to_trips_parallel(
+    xml_path, nr_processes=None, nr_shards=None, crs="EPSG:4326"
+):
+    """
+    Convert a MATSim population file into trips with a pool of processes.
+    The file is split into byte ranges of complete persons, each shard is
+    converted separately (activities_to_trips only shifts rows within a
+    person), and the results are merged in the order of the serial path.
+    """
+    nr_processes = nr_processes or os.cpu_count()
+    shards = find_person_shards(xml_path, nr_shards or 4 * nr_processes)
+    if len(shards) == 0:
+        # no persons in the file (same output as the serial path)
+        return activities_to_trips(_buffers_to_gdf(defaultdict(list), crs))
+    with ProcessPoolExecutor(max_workers=nr_processes) as pool:
+        shard_trips = list(
+            pool.map(
+                _shard_to_trips,
+                [(xml_path, byte_range, crs) for byte_range in shards],
+            )
+        )
+    trips_df = pd.concat(shard_trips, ignore_index=True)
+    trips_df.sort_values(["person_id", "activity_index"], inplace=True)
+    return trips_df
@@ -1,11 +1,18 @@
+import os
+import numpy as np
 import pandas as pd
 from shapely import wkt
 import geopandas as gpd
 from ast import literal_eval
 
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
 
 def read_trips_csv(path, geom_col="geom_origin", crs="EPSG:4326"):
-    trips = pd.read_csv(path)
+    return _parse_trips_csv(pd.read_csv(path), geom_col, crs)
+
+
+def _parse_trips_csv(trips, geom_col, crs):
     trips["geom_origin"] = trips["geom_origin"].apply(wkt.loads)
     trips["geom_destination"] = trips["geom_destination"].apply(wkt.loads)
     for time_col in ["started_at_origin", "started_at_destination"]:
@@ -17,13 +24,14 @@ def read_trips_csv(path, geom_col="geom_origin", crs="EPSG:4326"):
     return trips
 
 
-def write_trips_csv(trips, path):
+def write_trips_csv(trips, path, mode="w"):
     trips_out = trips.copy()
-    trips_out["geom_origin"] = trips_out["geom_origin"].apply(wkt.dumps)
-    trips_out["geom_destination"] = trips_out["geom_destination"].apply(
-        wkt.dumps
-    )
-    trips_out.to_csv(path, index=False)
+    for geom_col in ["geom_origin", "geom_destination"]:
+        # the geometries may have been removed before saving
+        if geom_col in trips_out.columns:
+            trips_out[geom_col] = trips_out[geom_col].apply(wkt.dumps)
+    # with mode="a", the trips are appended without header
+    trips_out.to_csv(path, index=False, mode=mode, header=(mode == "w"))
 
 
 def write_stations_csv(stations, path):
@@ -39,3 +47,114 @@ def read_stations_csv(path, geom_col="geom", crs="EPSG:4326"):
     station_df["geom"] = station_df["geom"].apply(wkt.loads)
     station_df = gpd.GeoDataFrame(station_df, geometry="geom", crs=crs)
     return station_df
+
+
+def is_parquet(path):
+    return os.path.splitext(path)[1].lower() in PARQUET_EXTENSIONS
+
+
+def _read_parquet(path, geom_cols, crs):
+    """Read a (Geo)Parquet file and label all geometry columns with the crs"""
+    try:
+        df = gpd.read_parquet(path)
+    except ValueError:
+        # no geometry columns (e.g. saved with remove_geom)
+        return pd.read_parquet(path)
+    for col in geom_cols:
+        if col in df.columns:
+            df[col] = gpd.GeoSeries(df[col]).set_crs(crs, allow_override=True)
+    return df
+
+
+def _write_parquet(df, path, geom_cols):
+    """Write a dataframe with (possibly several) geometry columns as WKB"""
+    df_out = pd.DataFrame(df).copy()
+    geom_cols = [col for col in geom_cols if col in df_out.columns]
+    if len(geom_cols) == 0:
+        df_out.to_parquet(path, index=False)
+        return
+    crs = getattr(df, "crs", None)
+    for col in geom_cols:
+        df_out[col] = gpd.GeoSeries(df_out[col], crs=crs)
+    gpd.GeoDataFrame(df_out, geometry=geom_cols[0]).to_parquet(
+        path, index=False
+    )
+
+
+def read_trips_parquet(path, geom_col="geom_origin", crs="EPSG:4326"):
+    trips = _read_parquet(path, ["geom_origin", "geom_destination"], crs)
+    if geom_col not in trips.columns:
+        return trips
+    trips = gpd.GeoDataFrame(trips)
+    trips.set_geometry(geom_col, inplace=True)
+    return trips
+
+
+def write_trips_parquet(trips, path):
+    _write_parquet(trips, path, ["geom_origin", "geom_destination"])
+
+
+def read_stations_parquet(path, geom_col="geom", crs="EPSG:4326"):
+    station_df = (
+        _read_parquet(path, [geom_col, "geom"], crs)
+        .set_index("station_no")
+        .rename(columns={geom_col: "geom"})
+    )
+    # lists are loaded as arrays
+    station_df["vehicle_list"] = [
+        np.asarray(veh_list).tolist() for veh_list in station_df["vehicle_list"]
+    ]
+    station_df = gpd.GeoDataFrame(station_df, geometry="geom", crs=crs)
+    return station_df
+
+
+def write_stations_parquet(stations, path):
+    _write_parquet(stations, path, ["geom"])
+
+
+def read_trips(path, geom_col="geom_origin", crs="EPSG:4326"):
+    """Read trips from csv or parquet file (depending on the extension)"""
+    if is_parquet(path):
+        return read_trips_parquet(path, geom_col=geom_col, crs=crs)
+    return read_trips_csv(path, geom_col=geom_col, crs=crs)
+
+
+def read_trips_chunks(
+    path, chunksize=100000, geom_col="geom_origin", crs="EPSG:4326"
+):
+    """Read trips from csv or parquet file in chunks of chunksize rows"""
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunksize)
+        for batch in batches:
+            trips = batch.to_pandas()
+            for col in ["geom_origin", "geom_destination"]:
+                trips[col] = gpd.GeoSeries.from_wkb(trips[col], crs=crs)
+            yield gpd.GeoDataFrame(trips, geometry=geom_col, crs=crs)
+        return
+    for trips in pd.read_csv(path, chunksize=chunksize):
+        yield _parse_trips_csv(trips, geom_col, crs)
+
+
+def write_trips(trips, path):
+    """Write trips to csv or parquet file (depending on the extension)"""
+    if is_parquet(path):
+        write_trips_parquet(trips, path)
+    else:
+        write_trips_csv(trips, path)
+
+
+def read_stations(path, geom_col="geom", crs="EPSG:4326"):
+    """Read stations from csv or parquet file (depending on the extension)"""
+    if is_parquet(path):
+        return read_stations_parquet(path, geom_col=geom_col, crs=crs)
+    return read_stations_csv(path, geom_col=geom_col, crs=crs)
+
+
+def write_stations(stations, path):
+    """Write stations to csv or parquet file (depending on the extension)"""
+    if is_parquet(path):
+        write_stations_parquet(stations, path)
+    else:
+        write_stations_csv(stations, path)
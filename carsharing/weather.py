@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import pandas as pd
+
+KEY_COLS = ["cell_x", "cell_y", "date"]
+
+
+def snap_to_cells(lon, lat, cell_size=0.1):
+    """Index of the grid cell (in degrees) of each point"""
+    cell_x = np.floor(np.asarray(lon, dtype=float) / cell_size).astype(int)
+    cell_y = np.floor(np.asarray(lat, dtype=float) / cell_size).astype(int)
+    return cell_x, cell_y
+
+
+def fetch_daily_weather(lon, lat, date):
+    """
+    Daily weather at a location from meteostat (one row), or None if there
+    is no data. If no data is found at the default altitude, a few
+    altitudes are tried.
+    """
+    # import of meteostat here in order to remove the requirement
+    from meteostat import Daily
+    from meteostat import Point as MeteoPoint
+
+    for altitude in [None, 100, 250, 500]:
+        loc = MeteoPoint(lat, lon, altitude)
+        data = Daily(loc, date, date).fetch()
+        if len(data) == 1:
+            return data.iloc[0]
+    return None
+
+
+def read_weather_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return pd.DataFrame(
+            {
+                "cell_x": pd.Series(dtype=int),
+                "cell_y": pd.Series(dtype=int),
+                "date": pd.Series(dtype="datetime64[ns]"),
+            }
+        )
+    cache = pd.read_csv(cache_path)
+    cache["date"] = pd.to_datetime(cache["date"]).astype("datetime64[ns]")
+    return cache
+
+
+def weather_from_table(keys, weather_table, cell_size=0.1):
+    """
+    Weather per (cell, day) from a local table with a date column and one
+    column per weather variable. If the table has lon and lat columns, the
+    rows are matched by grid cell and day, otherwise by day only.
+    """
+    weather_table = weather_table.copy()
+    weather_table["date"] = (
+        pd.to_datetime(weather_table["date"])
+        .dt.normalize()
+        .astype("datetime64[ns]")
+    )
+    if "lon" in weather_table.columns and "lat" in weather_table.columns:
+        weather_table["cell_x"], weather_table["cell_y"] = snap_to_cells(
+            weather_table["lon"], weather_table["lat"], cell_size
+        )
+        weather_table = weather_table.drop(["lon", "lat"], axis=1)
+        on = KEY_COLS
+    else:
+        on = ["date"]
+    # one row per key (average if there are several stations in a cell)
+    weather_table = weather_table.groupby(on).mean(numeric_only=True)
+    return keys.merge(weather_table, how="left", left_on=on, right_index=True)
+
+
+def lookup_daily_weather(
+    lon, lat, time, cell_size=0.1, cache_path=None, weather_table=None
+):
+    """
+    Daily weather for points (in EPSG:4326) and times
+
+    The points are snapped to a grid of cell_size degrees and the times to
+    days, and the weather is only looked up once per unique (cell, day). If
+    a local weather_table is given, the weather is taken from it (no network
+    access). Otherwise it is fetched from meteostat at the cell centre, and
+    the fetched rows are stored in the csv file cache_path, so that they are
+    not fetched again by later feature builds.
+    Returns a dataframe with one row per point.
+    """
+    cell_x, cell_y = snap_to_cells(lon, lat, cell_size)
+    date = pd.DatetimeIndex(time)
+    if date.tz is not None:
+        # local date
+        date = date.tz_localize(None)
+    points = pd.DataFrame(
+        {
+            "cell_x": cell_x,
+            "cell_y": cell_y,
+            "date": date.normalize().astype("datetime64[ns]"),
+        }
+    )
+    keys = points.drop_duplicates().reset_index(drop=True)
+    print("Unique (cell, day) pairs for weather:", len(keys))
+
+    if weather_table is not None:
+        weather = weather_from_table(keys, weather_table, cell_size)
+    else:
+        cache = read_weather_cache(cache_path)
+        missing = keys.merge(cache[KEY_COLS], how="left", indicator=True)
+        missing = missing[missing["_merge"] == "left_only"][KEY_COLS]
+        fetched = []
+        for cell_x, cell_y, day in missing.itertuples(index=False):
+            data = fetch_daily_weather(
+                (cell_x + 0.5) * cell_size,
+                (cell_y + 0.5) * cell_size,
+                day.to_pydatetime(),
+            )
+            row = {"cell_x": cell_x, "cell_y": cell_y, "date": day}
+            if data is not None:
+                row.update(data.to_dict())
+            fetched.append(row)
+        if len(fetched) > 0:
+            cache = pd.concat([cache, pd.DataFrame(fetched)], ignore_index=True)
+            if cache_path is not None:
+                cache.to_csv(cache_path, index=False)
+        weather = keys.merge(cache, how="left", on=KEY_COLS)
+
+    weather_cols = [col for col in weather.columns if col not in KEY_COLS]
+    return points.merge(weather, how="left", on=KEY_COLS)[weather_cols]
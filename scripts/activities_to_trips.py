@@ -1,8 +1,13 @@
 import os
-from carsharing.trip_loading_utils import xml_to_activities, activities_to_trips
+from carsharing.trip_loading_utils import (
+    xml_to_activities,
+    activities_to_trips,
+    xml_to_trips_chunked,
+    xml_to_trips_parallel,
+)
 
 if __name__ == "__main__":
-    from carsharing.utils import write_trips_csv
+    from carsharing.utils import write_trips
     import argparse
 
     parser = argparse.ArgumentParser()
@@ -20,8 +25,35 @@ if __name__ == "__main__":
         default=os.path.join("data", "siouxfalls_trips.csv"),
         help="Path where to output the trips",
     )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        type=int,
+        default=0,
+        help="if > 0, convert and write the trips in chunks of this many persons",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        help="if > 1, convert shards of the population file in parallel",
+    )
     args = parser.parse_args()
 
-    act_df = xml_to_activities(args.inp_path, crs="EPSG:26914")
-    trips_df = activities_to_trips(act_df)
-    write_trips_csv(trips_df, args.out_path)
+    if args.chunksize > 0:
+        xml_to_trips_chunked(
+            args.inp_path,
+            args.out_path,
+            chunk_size=args.chunksize,
+            crs="EPSG:26914",
+        )
+    elif args.processes > 1:
+        trips_df = xml_to_trips_parallel(
+            args.inp_path, nr_processes=args.processes, crs="EPSG:26914"
+        )
+        write_trips(trips_df, args.out_path)
+    else:
+        act_df = xml_to_activities(args.inp_path, crs="EPSG:26914")
+        trips_df = activities_to_trips(act_df)
+        write_trips(trips_df, args.out_path)
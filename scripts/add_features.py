@@ -1,10 +1,10 @@
 import os
-from carsharing.features import ModeChoiceFeatures
+from carsharing.features import ModeChoiceFeatures, add_features_chunked
 
 
 if __name__ == "__main__":
     import argparse
-    from carsharing.utils import read_trips_csv, read_stations_csv
+    from carsharing.utils import read_trips, read_stations
 
     # args
     parser = argparse.ArgumentParser()
@@ -34,16 +34,42 @@ if __name__ == "__main__":
         type=str,
         default=os.path.join("data", "siouxfalls_trips_features.csv"),
     )
+    parser.add_argument(
+        "-n",
+        "--nr_candidates",
+        default=0,
+        type=int,
+        help="if > 0, save the closest n stations of each trip origin",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        default=0,
+        type=int,
+        help="if > 0, compute and write the features in chunks of this many trips",
+    )
     args = parser.parse_args()
 
-    trips = read_trips_csv(args.in_path, crs="EPSG:26914")
-    stations = read_stations_csv(
+    stations = read_stations(
         args.station_path, geom_col="geometry", crs="EPSG:26914"
     )
 
-    feat_collector = ModeChoiceFeatures(trips, stations)
-    feat_collector.add_all_features()
-    feat_collector.save(
-        out_path=args.out_path, remove_geom=(not args.keep_geom)
-    )
+    if args.chunksize > 0:
+        if args.nr_candidates > 0:
+            raise ValueError("Station candidates are not saved in chunked mode")
+        add_features_chunked(
+            args.in_path,
+            stations,
+            args.out_path,
+            chunksize=args.chunksize,
+            remove_geom=(not args.keep_geom),
+            crs="EPSG:26914",
+        )
+    else:
+        trips = read_trips(args.in_path, crs="EPSG:26914")
+        feat_collector = ModeChoiceFeatures(trips, stations)
+        feat_collector.add_all_features(nr_candidates=args.nr_candidates)
+        feat_collector.save(
+            out_path=args.out_path, remove_geom=(not args.keep_geom)
+        )
 
@@ -0,0 +1,84 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from carsharing.car_sharing_patterns import RANDOM_DATE, sort_decision_times
+
+
+def synthetic_trips(nr_trips, mean_chain_length=4, seed=0):
+    """Random activity chains, sorted by person and activity index"""
+    rng = np.random.default_rng(seed)
+    chain_lengths = rng.poisson(mean_chain_length - 1, nr_trips) + 1
+    # each chain has at least one trip, so there are enough persons
+    person_id = np.repeat(np.arange(nr_trips), chain_lengths)[:nr_trips]
+    # activities start every 5 to 120 minutes, the drive times are rough
+    # approximations and can exceed the gap between activities
+    started_at = RANDOM_DATE + pd.to_timedelta(
+        pd.Series(rng.uniform(5, 120, nr_trips)).groupby(person_id).cumsum(),
+        unit="min",
+    )
+    drive_time = rng.exponential(20, nr_trips) + 10
+    decision_time = started_at - pd.to_timedelta(drive_time, unit="min")
+    return pd.DataFrame(
+        {"person_id": person_id, "mode_decision_time": decision_time}
+    )
+
+
+def sort_decision_times_iterative(trips):
+    """Previous implementation: one shift-and-compare pass per cascade step"""
+    trips = trips.copy()
+    cond1, cond2 = np.array([True]), np.array([True])
+    nr_passes = 0
+    while np.sum(cond1 & cond2) > 0:
+        nr_passes += 1
+        trips["prev_dec_time"] = trips["mode_decision_time"].shift(1)
+        trips["prev_person"] = trips["person_id"].shift(1)
+        cond1 = trips["prev_dec_time"] > trips["mode_decision_time"]
+        cond2 = trips["prev_person"] == trips["person_id"]
+        if sum(cond1 & cond2) > 0:
+            trips.loc[(cond1 & cond2), "mode_decision_time"] = trips.loc[
+                (cond1 & cond2), "prev_dec_time"
+            ] + pd.Timedelta(minutes=2)
+    print("Number of passes of the iterative implementation:", nr_passes)
+    return trips["mode_decision_time"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--nr_trips",
+        type=int,
+        default=10000000,
+        help="number of synthetic trips",
+    )
+    parser.add_argument(
+        "--skip_iterative",
+        action="store_true",
+        help="only time the single-pass implementation",
+    )
+    args = parser.parse_args()
+
+    trips = synthetic_trips(args.nr_trips)
+    print(
+        "Number of trips", len(trips), "persons", trips["person_id"].nunique()
+    )
+
+    tic = time.time()
+    decision_time = (
+        pd.DatetimeIndex(trips["mode_decision_time"]).as_unit("ns").asi8
+    )
+    corrected = sort_decision_times(trips["person_id"].values, decision_time)
+    time_single_pass = time.time() - tic
+    print(f"Single-pass implementation: {time_single_pass:.2f}s")
+
+    if not args.skip_iterative:
+        tic = time.time()
+        corrected_iterative = sort_decision_times_iterative(trips)
+        time_iterative = time.time() - tic
+        print(f"Iterative implementation: {time_iterative:.2f}s")
+        assert np.array_equal(
+            corrected,
+            pd.DatetimeIndex(corrected_iterative).as_unit("ns").asi8,
+        ), "implementations give different decision times"
+        print(f"Speedup: {time_iterative / time_single_pass:.1f}x")
@@ -0,0 +1,98 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from carsharing.features import ModeChoiceFeatures
+
+PURPOSES = ["home", "leisure", "work", "shopping", "education"]
+
+
+def synthetic_trips(nr_trips, seed=0):
+    rng = np.random.default_rng(seed)
+    started_at = pd.to_datetime("2020-01-20") + pd.to_timedelta(
+        rng.uniform(0, 7 * 24 * 60, nr_trips), unit="min"
+    )
+    return gpd.GeoDataFrame(
+        {
+            "started_at_origin": started_at,
+            "purpose_destination": rng.choice(PURPOSES + ["other"], nr_trips),
+        },
+        geometry=gpd.points_from_xy(np.zeros(nr_trips), np.zeros(nr_trips)),
+        crs="EPSG:26914",
+    )
+
+
+def add_purpose_features_apply(trips, col_name="purpose_destination"):
+    """Previous implementation: get_dummies and merge"""
+    occuring = trips[col_name].unique()
+    included_w_prefix = ["feat_" + col_name + "_" + p for p in PURPOSES]
+    included_and_occuring = [
+        p for p in included_w_prefix if p.split("_")[-1] in occuring
+    ]
+    one_hot = pd.get_dummies(trips[col_name], prefix="feat_" + col_name)[
+        included_and_occuring
+    ]
+    for p in included_w_prefix:
+        if p not in included_and_occuring:
+            one_hot[p] = 0
+    return trips.merge(one_hot, left_index=True, right_index=True)
+
+
+def add_time_features_apply(trips, origin_or_destination="origin"):
+    """Previous implementation: one python call per element"""
+    col_name = "started_at_" + origin_or_destination
+    trips[f"feat_{origin_or_destination}_hour"] = trips[col_name].apply(
+        lambda x: x.hour
+    )
+    trips[f"feat_{origin_or_destination}_day"] = trips[col_name].apply(
+        lambda x: x.dayofweek
+    )
+    return trips
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--nr_trips",
+        type=int,
+        default=1000000,
+        help="number of synthetic trips",
+    )
+    args = parser.parse_args()
+
+    trips = synthetic_trips(args.nr_trips)
+    feat_collector = ModeChoiceFeatures(trips.copy(), stations=None)
+
+    tic = time.time()
+    old_trips = add_purpose_features_apply(trips.copy())
+    time_old = time.time() - tic
+    tic = time.time()
+    feat_collector.add_purpose_features("purpose_destination")
+    time_new = time.time() - tic
+    print(
+        f"Purpose features: {time_old:.2f}s (get_dummies + merge), "
+        f"{time_new:.2f}s (categorical codes), "
+        f"speedup {time_old / time_new:.1f}x"
+    )
+    for p in PURPOSES:
+        col = "feat_purpose_destination_" + p
+        assert np.array_equal(
+            old_trips[col].astype(int).values, feat_collector.trips[col].values
+        )
+
+    tic = time.time()
+    old_trips = add_time_features_apply(trips.copy())
+    time_old = time.time() - tic
+    tic = time.time()
+    feat_collector.add_time_features("origin")
+    time_new = time.time() - tic
+    print(
+        f"Time features: {time_old:.2f}s (apply), {time_new:.2f}s (.dt), "
+        f"speedup {time_old / time_new:.1f}x"
+    )
+    for col in ["feat_origin_hour", "feat_origin_day"]:
+        assert np.array_equal(
+            old_trips[col].values, feat_collector.trips[col].values
+        )
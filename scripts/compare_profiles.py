@@ -0,0 +1,26 @@
+import argparse
+import pandas as pd
+from carsharing.profiling import read_profiles, compare_runs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths", nargs="+", type=str, help="JSON lines files with the spans",
+    )
+    parser.add_argument(
+        "-v",
+        "--value",
+        type=str,
+        default="duration",
+        help="field to compare (duration or a counter, e.g. predict_calls)",
+    )
+    args = parser.parse_args()
+
+    profiles = read_profiles(args.paths)
+    table = compare_runs(profiles, value=args.value)
+    if table.shape[1] > 1:
+        # relative to the first run
+        for run in table.columns[1:]:
+            table[f"ratio_{run}"] = table[run] / table[table.columns[0]]
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(table)
@@ -0,0 +1,53 @@
+import os
+from carsharing.utils import (
+    read_trips_csv,
+    read_stations_csv,
+    write_trips_parquet,
+    write_stations_parquet,
+)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--inp_path",
+        type=str,
+        default=os.path.join("data", "siouxfalls_trips.csv"),
+        help="Path to trips or stations csv file",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_path",
+        type=str,
+        default=None,
+        help="Path to output parquet file (default: same name as input)",
+    )
+    parser.add_argument(
+        "-t",
+        "--table_type",
+        type=str,
+        default="trips",
+        help="one of trips or stations",
+    )
+    parser.add_argument(
+        "-c", "--crs", type=str, default="EPSG:26914", help="CRS of the data"
+    )
+    args = parser.parse_args()
+
+    out_path = args.out_path
+    if out_path is None:
+        out_path = os.path.splitext(args.inp_path)[0] + ".parquet"
+
+    if args.table_type == "trips":
+        trips = read_trips_csv(args.inp_path, crs=args.crs)
+        write_trips_parquet(trips, out_path)
+    elif args.table_type == "stations":
+        stations = read_stations_csv(
+            args.inp_path, geom_col="geometry", crs=args.crs
+        )
+        write_stations_parquet(stations.reset_index(), out_path)
+    else:
+        raise ValueError("table_type must be one of [trips, stations]")
+    print("Saved", args.table_type, "to", out_path)
@@ -3,13 +3,19 @@ import os
 import pickle
 import argparse
 import pandas as pd
-from carsharing.features import compute_dist_to_station
+from carsharing.features import (
+    compute_dist_to_station,
+    nearest_station_candidates,
+    load_station_candidates,
+)
 from carsharing.car_sharing_patterns import (
     derive_decision_time,
     derive_reservations,
     assign_mode,
 )
-from carsharing.utils import read_stations_csv, read_trips_csv
+from carsharing.event_engine import assign_mode_events, simulate_days
+from carsharing.recorder import OccupancyRecorder
+from carsharing.utils import read_stations, read_trips
 from carsharing.mode_choice_models import BasicModeChoice
 
 if __name__ == "__main__":
@@ -43,6 +49,43 @@ if __name__ == "__main__":
         default=os.path.join("trained_models", "xgb.p"),
         help="path to mode choice model",
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        type=str,
+        default="events",
+        help="one of events (event-based engine) or iterrows (legacy loop)",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=256,
+        help="number of decisions per window for batched mode choice",
+    )
+    parser.add_argument(
+        "-d",
+        "--days",
+        type=int,
+        default=1,
+        help="number of consecutive days to simulate (event engine only)",
+    )
+    parser.add_argument(
+        "-n",
+        "--nr_candidates",
+        type=int,
+        default=8,
+        help="number of closest stations per trip that are precomputed "
+        "(0 to always search the closest available station)",
+    )
+    parser.add_argument(
+        "-r",
+        "--record_interval",
+        type=str,
+        default=None,
+        help="if given (e.g. 15min), record the available vehicles per "
+        "station at this interval in occupancy.npz (event engine only)",
+    )
     # path to use for postgis_json_path argument: "../../dblogin_mielab.json"
     args = parser.parse_args()
 
@@ -52,7 +95,9 @@ if __name__ == "__main__":
     os.makedirs(out_path, exist_ok=True)
 
     # load activities and shared-cars availability
-    acts_gdf = read_trips_csv(in_path_sim_trips, crs="EPSG:26914")
+    acts_gdf = read_trips(in_path_sim_trips, crs="EPSG:26914")
+    # to find the rows of the trips file again (for the station candidates)
+    file_index = acts_gdf.index
     acts_gdf.index.name = "id"
     acts_gdf.reset_index(inplace=True)
     # define mode choice model
@@ -64,7 +109,7 @@ if __name__ == "__main__":
         with open(args.model_path, "rb") as infile:
             mode_choice_model = pickle.load(infile)
 
-    station_scenario = read_stations_csv(
+    station_scenario = read_stations(
         args.station_scenario, geom_col="geometry", crs="EPSG:26914"
     )
 
@@ -88,23 +133,90 @@ if __name__ == "__main__":
     # get time when decision is made
     acts_gdf = derive_decision_time(acts_gdf)
 
-    # Run: iteratively assign modes
-    acts_gdf_mode = assign_mode(acts_gdf, station_scenario, mode_choice_model)
+    # closest stations of each trip origin, in case the closest one is empty
+    station_candidates = None
+    if args.nr_candidates > 0:
+        # use the table saved by add_features.py if it has the same stations
+        saved = load_station_candidates(
+            in_path_sim_trips, station_scenario, k=args.nr_candidates
+        )
+        if saved is not None and file_index.is_unique:
+            print("Using the station candidates saved with the features")
+            station_candidates = saved[0][
+                file_index.get_indexer(acts_gdf["id"])
+            ]
+        else:
+            station_candidates, _ = nearest_station_candidates(
+                acts_gdf["geom_origin"], station_scenario, k=args.nr_candidates
+            )
+
+    # record the occupancy over the whole simulated period
+    recorder = None
+    if args.record_interval is not None:
+        if args.engine != "events":
+            raise ValueError("recording requires the event engine")
+        recorder = OccupancyRecorder(
+            station_scenario.index.values,
+            acts_gdf["mode_decision_time"].min(),
+            acts_gdf["started_at_destination"].max()
+            + pd.Timedelta(days=args.days - 1),
+            interval=args.record_interval,
+        )
+
+    if args.days > 1:
+        if args.engine != "events":
+            raise ValueError("multi-day simulation requires the event engine")
+        # the results are written to the output folder day by day
+        simulate_days(
+            acts_gdf,
+            station_scenario,
+            mode_choice_model,
+            args.days,
+            out_path,
+            batch_size=args.batch_size,
+            station_candidates=station_candidates,
+            recorder=recorder,
+        )
+    else:
+        # Run: iteratively assign modes
+        if args.engine == "events":
+            acts_gdf_mode = assign_mode_events(
+                acts_gdf,
+                station_scenario,
+                mode_choice_model,
+                batch_size=args.batch_size,
+                station_candidates=station_candidates,
+                recorder=recorder,
+            )
+        elif args.engine == "iterrows":
+            acts_gdf_mode = assign_mode(
+                acts_gdf, station_scenario, mode_choice_model
+            )
+        else:
+            raise ValueError("engine must be one of [events, iterrows]")
 
-    # Save trip modes
-    acts_gdf_mode[
-        [
-            "person_id",
-            "activity_index",
-            "mode_decision_time",
-            "mode",
-            "vehicle_no",
-        ]
-    ].to_csv(os.path.join(out_path, "sim_modes.csv"), index=False)
+        # Save trip modes
+        acts_gdf_mode[
+            [
+                "person_id",
+                "activity_index",
+                "mode_decision_time",
+                "mode",
+                "vehicle_no",
+            ]
+        ].to_csv(os.path.join(out_path, "sim_modes.csv"), index=False)
 
-    # get shared only and derive the reservations by merging subsequent car sharing trips
-    sim_reservations = derive_reservations(acts_gdf_mode)
+        # get shared only and derive the reservations by merging subsequent car sharing trips
+        sim_reservations = derive_reservations(acts_gdf_mode)
 
-    # Save reservations
-    sim_reservations.to_csv(os.path.join(out_path, "sim_reservations.csv"))
+        # Save reservations
+        sim_reservations.to_csv(os.path.join(out_path, "sim_reservations.csv"))
 
+    if recorder is not None:
+        recorder.save(os.path.join(out_path, "occupancy.npz"))
+        print(
+            "Decisions with fallback to a further station:",
+            recorder.fallbacks.sum(),
+            "without any available vehicle:",
+            recorder.no_vehicle.sum(),
+        )
@@ -0,0 +1,212 @@
+import os
+import pickle
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from carsharing.features import (
+    compute_dist_to_station,
+    updated_station_columns,
+)
+from carsharing.car_sharing_patterns import (
+    derive_decision_time,
+    derive_reservations,
+)
+from carsharing.event_engine import assign_mode_events, CARSHARING_MODE
+from carsharing.utils import read_stations, read_trips
+from carsharing.mode_choice_models import BasicModeChoice
+
+# data that is shared with the worker processes (set by init_worker)
+SHARED = {}
+
+
+def init_worker(
+    trips, base_stations, mode_choice_model, batch_size, nr_days
+):
+    # with the fork start method, the arguments are inherited from the parent
+    # process (copy-on-write) instead of being pickled for each worker
+    SHARED["trips"] = trips
+    SHARED["base_stations"] = base_stations
+    SHARED["mode_choice_model"] = mode_choice_model
+    SHARED["batch_size"] = batch_size
+    SHARED["nr_days"] = nr_days
+
+
+def reservation_kpis(
+    acts_gdf_mode, sim_reservations, station_scenario, nr_days=1
+):
+    """
+    Aggregate KPIs of one simulation run. The utilization is relative to the
+    simulated days (not to the end of the last reservation), so that it is
+    comparable between runs. sim_reservations can be None if there are no
+    car sharing trips.
+    """
+    if sim_reservations is None or len(sim_reservations) == 0:
+        return {
+            "nr_reservations": 0,
+            "nr_users": 0,
+            "mode_share": 0.0,
+            "utilization": 0.0,
+            "mean_duration": 0.0,
+            "total_drive_km": 0.0,
+        }
+    nr_vehicles = station_scenario["vehicle_list"].apply(len).sum()
+    # reserved hours per vehicle and hour of the simulated day(s)
+    horizon_h = 24 * nr_days
+    return {
+        "nr_reservations": len(sim_reservations),
+        "nr_users": sim_reservations["person_no"].nunique(),
+        "mode_share": np.mean(acts_gdf_mode["mode"] == CARSHARING_MODE),
+        "utilization": sim_reservations["duration"].sum()
+        / (nr_vehicles * horizon_h),
+        "mean_duration": sim_reservations["duration"].mean(),
+        "total_drive_km": sim_reservations["drive_km"].sum(),
+    }
+
+
+def run_scenario(task):
+    """Simulate one station scenario with one seed and return its KPIs"""
+    station_path, seed = task
+    np.random.seed(seed)
+    station_scenario = read_stations(
+        station_path, geom_col="geometry", crs="EPSG:26914"
+    )
+    # the shared trips must not be modified: only the columns of the closest
+    # stations are recomputed, and they are set on a shallow copy that shares
+    # all other columns with the trips of the parent process
+    acts_gdf = SHARED["trips"].copy(deep=False)
+    for col, values in updated_station_columns(
+        acts_gdf, station_scenario, SHARED["base_stations"]
+    ).items():
+        acts_gdf[col] = values
+    acts_gdf_mode = assign_mode_events(
+        acts_gdf,
+        station_scenario,
+        SHARED["mode_choice_model"],
+        batch_size=SHARED["batch_size"],
+    )
+    # a run without any car sharing trip has no reservations
+    sim_reservations = None
+    if np.any(acts_gdf_mode["mode"] == CARSHARING_MODE):
+        sim_reservations = derive_reservations(acts_gdf_mode)
+    kpis = {"station_scenario": station_path, "seed": seed}
+    kpis.update(
+        reservation_kpis(
+            acts_gdf_mode,
+            sim_reservations,
+            station_scenario,
+            nr_days=SHARED["nr_days"],
+        )
+    )
+    return kpis
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--in_path_sim_trips",
+        type=str,
+        default=os.path.join("data", "siouxfalls_trips_features.csv"),
+        help="path to simulated trips csv",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_path",
+        type=str,
+        default=os.path.join("outputs", "scenarios.csv"),
+        help="path to save the KPIs of all runs",
+    )
+    parser.add_argument(
+        "-s",
+        "--station_scenarios",
+        type=str,
+        nargs="+",
+        default=[os.path.join("data", "stations.csv")],
+        help="paths to station scenarios",
+    )
+    parser.add_argument(
+        "-n",
+        "--nr_seeds",
+        type=int,
+        default=10,
+        help="number of seeds per station scenario",
+    )
+    parser.add_argument(
+        "-m",
+        "--model_path",
+        type=str,
+        default=os.path.join("trained_models", "xgb.p"),
+        help="path to mode choice model",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=256,
+        help="number of decisions per window for batched mode choice",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=None,
+        help="number of worker processes",
+    )
+    args = parser.parse_args()
+
+    # load trips and derive the decision times once (independent of stations)
+    acts_gdf = read_trips(args.in_path_sim_trips, crs="EPSG:26914")
+    acts_gdf.index.name = "id"
+    acts_gdf.reset_index(inplace=True)
+    acts_gdf.sort_values(["person_id", "activity_index"], inplace=True)
+    acts_gdf = derive_decision_time(acts_gdf)
+    # closest stations of the first scenario, which are updated for the others
+    base_stations = read_stations(
+        args.station_scenarios[0], geom_col="geometry", crs="EPSG:26914"
+    )
+    acts_gdf = compute_dist_to_station(acts_gdf, base_stations)
+    # the trips stay sorted by person in all runs
+    acts_gdf.sort_values(["person_id", "activity_index"], inplace=True)
+    # number of simulated days (the horizon of the utilization)
+    nr_days = max(1, acts_gdf["started_at_origin"].dt.normalize().nunique())
+
+    if args.model_path == "simple":
+        mode_choice_model = BasicModeChoice()
+        print("Using basic mode choice model")
+    else:
+        with open(args.model_path, "rb") as infile:
+            mode_choice_model = pickle.load(infile)
+
+    tasks = [
+        (station_path, seed)
+        for station_path in args.station_scenarios
+        for seed in range(args.nr_seeds)
+    ]
+    mp_context = (
+        multiprocessing.get_context("fork")
+        if "fork" in multiprocessing.get_all_start_methods()
+        else None
+    )
+    with ProcessPoolExecutor(
+        max_workers=args.processes,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(
+            acts_gdf,
+            base_stations,
+            mode_choice_model,
+            args.batch_size,
+            nr_days,
+        ),
+    ) as pool:
+        results = pd.DataFrame(pool.map(run_scenario, tasks))
+
+    os.makedirs(os.path.dirname(args.out_path) or ".", exist_ok=True)
+    results.to_csv(args.out_path, index=False)
+    print(
+        results.groupby("station_scenario")
+        .agg(["mean", "std"])
+        .drop("seed", axis=1, level=0)
+    )
@@ -2,8 +2,12 @@ import os
 import argparse
 import pandas as pd
 import numpy as np
-from carsharing.stations import place_new_stations, place_vehicles
-from carsharing.utils import read_trips_csv, write_stations_csv
+from carsharing.stations import (
+    place_new_stations,
+    place_new_stations_minibatch,
+    place_vehicles,
+)
+from carsharing.utils import read_trips, write_stations
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -35,6 +39,13 @@ if __name__ == "__main__":
         default=100,
         help="How many stations to place",
     )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        type=int,
+        default=0,
+        help="if > 0, stream the trips in chunks of this size (mini-batch KMeans)",
+    )
     args = parser.parse_args()
 
     existing_stations = pd.read_csv(args.fixed_stations)
@@ -44,7 +55,15 @@ if __name__ == "__main__":
         assert "x" in existing_stations.columns and "y" in existing_stations.columns, "station table requires x and y coordinates"
         station_locations = np.array(existing_stations[["x", "y"]])
 
-    trips = read_trips_csv(args.inp_path)
-    stations = place_new_stations(args.number_stations, trips, station_locations=station_locations)
+    if args.chunksize > 0:
+        stations = place_new_stations_minibatch(
+            args.number_stations,
+            args.inp_path,
+            station_locations=station_locations,
+            chunksize=args.chunksize,
+        )
+    else:
+        trips = read_trips(args.inp_path)
+        stations = place_new_stations(args.number_stations, trips, station_locations=station_locations)
     stations = place_vehicles(stations)
-    write_stations_csv(stations.reset_index(), args.out_path)
+    write_stations(stations.reset_index(), args.out_path)
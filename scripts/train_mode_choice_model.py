@@ -6,6 +6,7 @@ import numpy as np
 from sklearn.model_selection import train_test_split
 from carsharing.mode_choice_models import RandomForestWrapper, rf_tuning
 from carsharing.plotting import plot_confusion_matrix, plot_feature_importance
+from carsharing.utils import is_parquet
 
 def prepare_data(trips, min_number_trips=200, return_normed=False, drop_columns=[]):
     # drop geometry if it exists
@@ -83,7 +84,7 @@ def fit_random_forest(trips_mobis, out_path=os.path.join("outputs", "mode_choice
     rf_wrapper.fit(features, labels)
 
     # save train accuracy
-    train_pred = rf_wrapper(features)
+    train_pred = rf_wrapper.predict_modes(features)
     plot_confusion_matrix(train_pred, labels_max_str, traintest="TRAIN", out_path=out_path)
 
     # print most important features
@@ -119,7 +120,10 @@ if __name__ == "__main__":
     os.makedirs(out_path, exist_ok=True)
 
     # load data
-    trips_mobis = pd.read_csv(args.in_path_mobis)
+    if is_parquet(args.in_path_mobis):
+        trips_mobis = pd.read_parquet(args.in_path_mobis)
+    else:
+        trips_mobis = pd.read_csv(args.in_path_mobis)
 
     f = open(os.path.join(out_path, "stdout_model_train_test.txt"), "w")
     sys.stdout = f